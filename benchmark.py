@@ -0,0 +1,223 @@
+# A program to measure how fast every filter runs.
+"""
+A program to measure how fast every filter runs.
+Use in the following way:
+    python3 benchmark.py [--images examples/original] [--filters all]
+                         [--scales 1 2 4] [--repeat 1]
+                         [--output results/benchmark.json]
+                         [--baseline {earlier output}] [--threshold 1.25]
+Every filter is applied to every image, each upscaled by every scale.
+Every run happens in a fresh process, so its peak memory is its own.
+The wall time, peak resident memory and the time spent in each stage
+(decode, cluster, map, dfs, encode) of every run are saved as json;
+dfs is the search for the regions of Rehatch's squares.
+Given a baseline (the output of an earlier run), runs that got slower or
+bigger by more than threshold times are reported, and the program exits
+with status 1.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+from time import perf_counter
+
+from PIL import Image
+
+from filter.profile import tracing
+
+# filter.py shares its name with the filter package, so it is loaded by path
+FILTER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'filter.py')
+# commands fed to the filters that need some
+COMMANDS = {
+    'recolor': ['FBFAF6', '929DA3', 'E2EDE5', 'DB2521', '20101A'],
+    'remap': ['examples/original/monalisa.jpeg', 'examples/original/crew.jpeg'],
+}
+# every run uses the same seed, so runs do the same work
+SEED = 0
+# default factors images are upscaled by
+SCALES = [1, 2, 4]
+# changes shorter than this many seconds are noise, not regressions
+MIN_SECONDS = 0.05
+
+# filter.py, once loaded in this process
+_filters = None
+
+def loadFilters():
+    """Helper method for runCase.
+    The filter.py module, loaded the first time it is needed."""
+    global _filters
+    if _filters is None:
+        spec = importlib.util.spec_from_file_location('filterScript', FILTER_SCRIPT)
+        _filters = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_filters)
+    return _filters
+
+def peakRSS():
+    """The peak resident memory of this process, in megabytes."""
+    # getrusage keeps the peak of the process that started this one,
+    # while Linux's own count starts again with every new program
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / (1 << 10)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+def scaleImage(imagePath, scale, directory):
+    """Helper method for benchmark.
+    Save imagePath upscaled by scale in directory, in the same format,
+    and return the new path (or imagePath itself, for scale 1)."""
+    if scale == 1:
+        return imagePath
+    name, extension = os.path.splitext(os.path.basename(imagePath))
+    scaledPath = os.path.join(directory, '{}@{}x{}'.format(name, scale, extension))
+    with Image.open(imagePath) as image:
+        options = { 'quality': 95 } if image.format == 'JPEG' else {}
+        scaled = image.resize((image.width * scale, image.height * scale), Image.LANCZOS)
+        scaled.save(scaledPath, format=image.format, **options)
+    return scaledPath
+
+def runCase(case):
+    """Helper method for benchmark.
+    Apply one filter to one image, in the process this is called in,
+    after setting the filter.py globals in the case's optional settings.
+    Returns the case with the seconds, peak memory and stages added."""
+    filters = loadFilters()
+    filters.seed = SEED
+    # cached clusterings would skip the work being measured
+    filters.paletteCache = False
+    for name, value in case.get('settings', {}).items():
+        setattr(filters, name, value)
+    result = dict(case)
+    resultPath = case.get('resultPath') or os.path.join(case['directory'], 'result.png')
+    start = perf_counter()
+    try:
+        with tracing() as trace:
+            filters.pipeline([ (case['filter'], case['commands']) ], case['path'], resultPath)
+        result['error'] = None
+    # filters exit() on bad commands; report that instead of stopping
+    except SystemExit:
+        result['error'] = "filter exited"
+    except Exception as e:
+        result['error'] = repr(e)
+    result['seconds'] = perf_counter() - start
+    result['peakRSS'] = peakRSS()
+    result['stages'] = trace.stages
+    return result
+
+def runFresh(case):
+    """Run a case with runCase in a new process, so its memory is not
+    shared with earlier runs, and return the result."""
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+        return pool.submit(runCase, case).result()
+
+def benchmark(imageDirectory, filterNames, scales=SCALES, repeat=1):
+    """Run every filter in filterNames over every image in imageDirectory
+    at every scale, repeat times each, keeping the fastest run.
+    Prints each run as it finishes, and returns a list of results."""
+    filters = loadFilters()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for imagePath in filters.findImages(imageDirectory):
+            for scale in scales:
+                path = scaleImage(imagePath, scale, directory)
+                with Image.open(path) as image:
+                    width, height = image.size
+                for filterName in filterNames:
+                    case = { 'filter': filterName, 'image': imagePath, 'scale': scale,
+                             'width': width, 'height': height, 'path': path,
+                             'commands': COMMANDS.get(filterName, []),
+                             'directory': directory }
+                    runs = []
+                    for _ in range(repeat):
+                        runs.append(runFresh(case))
+                    result = min(runs, key=lambda run: run['seconds'])
+                    result['peakRSS'] = max(run['peakRSS'] for run in runs)
+                    del result['path'], result['directory']
+                    printResult(result)
+                    results.append(result)
+    return results
+
+def printResult(result):
+    """Helper method for benchmark.
+    Print one line about a result."""
+    if result['error'] is not None:
+        status = "failed: {}".format(result['error'])
+    else:
+        status = ' '.join( '{}={:.2f}'.format(name, seconds)
+                           for name, seconds in result['stages'].items() )
+    print("{:>8.2f}s {:>7.0f}MB  {:<9} {}x{:<5} {}  {}".format(
+        result['seconds'], result['peakRSS'], result['filter'], result['width'],
+        result['height'], result['image'], status))
+
+def compare(results, baseline, threshold):
+    """Return the regressions of results against baseline: a list of
+    (result, measure, old, new) for every run whose seconds or peakRSS
+    grew more than threshold times."""
+    old = { (b['filter'], b['image'], b['scale']): b for b in baseline['results'] }
+    regressions = []
+    for result in results:
+        before = old.get((result['filter'], result['image'], result['scale']))
+        if before is None or result['error'] is not None or before['error'] is not None:
+            continue
+        if result['seconds'] > before['seconds'] * threshold and \
+           result['seconds'] - before['seconds'] > MIN_SECONDS:
+            regressions.append((result, 'seconds', before['seconds'], result['seconds']))
+        if result['peakRSS'] > before['peakRSS'] * threshold:
+            regressions.append((result, 'peakRSS', before['peakRSS'], result['peakRSS']))
+    return regressions
+
+def main(argv):
+    """Command line for benchmark."""
+    parser = ArgumentParser(prog='benchmark.py',
+                            description='Measure how fast every filter runs.')
+    parser.add_argument('--images', default='examples/original',
+                        help='directory of images, or a glob')
+    parser.add_argument('--filters', nargs='+', default=['all'],
+                        help="filter names, or 'all'")
+    parser.add_argument('--scales', nargs='+', type=int, default=SCALES,
+                        help='factors to upscale every image by')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of every case; the fastest is kept')
+    parser.add_argument('--output', default='results/benchmark.json',
+                        help='where to save the results')
+    parser.add_argument('--baseline', default=None,
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='how many times slower or bigger is a regression')
+    args = parser.parse_args(argv)
+    filters = loadFilters()
+    filterNames = filters.filters if args.filters == ['all'] else args.filters
+    for filterName in filterNames:
+        if filterName not in filters.filters:
+            print("The filter {} does not exsist.".format(filterName))
+            exit(2)
+
+    results = benchmark(args.images, filterNames, args.scales, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump({ 'python': platform.python_version(), 'machine': platform.machine(),
+                    'seed': SEED, 'results': results }, f, indent=2)
+    print("Saved {} results to {}.".format(len(results), args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for result, measure, before, after in regressions:
+            print("REGRESSION {:<9} {} x{}: {} {:.2f} -> {:.2f}".format(
+                result['filter'], result['image'], result['scale'], measure, before, after))
+        if regressions:
+            exit(1)
+        print("No regressions against {}.".format(args.baseline))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,16 +1,72 @@
+import io
+import json
 import os
 import sys
-from random import randrange
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from glob import glob
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from socketserver import ThreadingMixIn, UnixStreamServer
+from time import perf_counter
+from urllib.parse import parse_qs, unquote, urlsplit
 
 from wand.image import Image as wandImage
-from PIL import Image, ImageFilter, ImageEnhance, ImageOps
+from PIL import Image, ImageFilter, ImageOps
+import numpy as np
 
 import re
+from filter.cache import PaletteCache, paletteKey
+from filter.cluster import MAX_ITER, SEEDING, TOLERANCE
+from filter.colorspace import SPACES
+from filter.glyphs import GLYPH_DIR, atlas
+from filter.profile import stage, tracing
+from filter.sequence import DRIFT, PaletteTracker, pipelined
+from filter.source import mapPixels, openImage
 from filter.recluster import Recolor, Rehatch, Remap
+from filter.stream import rowChunks
 
 # other commands to feed to filters
 commands = []
+# number of processes the PIL filters may draw with
+jobs = 1
+# seed for everything random in the filters; None for a different result each run
+seed = None
+# values sampled per mini-batch k-means iteration; None for full k-means
+batchSize = None
+# color space recolor clusters in: 'rgb', 'lab' or 'oklab'
+colorSpace = 'rgb'
+# cache of clusterings for recolor; created when first needed
+paletteCache = None
+# state shared between a preview and its full-resolution render
+previewState = None
+# the palette of the frames of a sequence so far; None outside sequences
+paletteTracker = None
+# default largest side of a preview
+PREVIEW_SIZE = 512
+# the dirt texture, found next to the glyphs wherever the program is run from
+DIRT_PATH = os.path.join(GLYPH_DIR, 'dirt.png')
+# the decoded dirt texture, and its resized copies by size, least recently used first
+dirtSource = None
+dirtTextures = OrderedDict()
+# pixels the resized copies may hold in all (the last one is always kept)
+MAX_DIRT_PIXELS = 16 << 20
 filters = ['noir', 'sepia', 'vignette', 'vintage', 'recolor', 'remap', 'pixelate', 'dots', 'pencil']
+# filters that work on ImageMagick (wand) images; the rest use PIL
+wandFilters = ['noir', 'sepia', 'vignette', 'vintage']
+# filters that read the pixels of uncompressed inputs mapped from the file
+arrayFilters = ['pixelate', 'dots', 'pencil']
+# files batch treats as images
+imageExtensions = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif')
+# default address of serve, and how many requests may wait for a worker
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8765
+MAX_WAITING = 16
+# how many bytes of a result are sent at a time
+SEND_CHUNK = 1 << 16
 
 def noir(image):
     """Noir filter emulating black-and-white films.
@@ -32,19 +88,49 @@ def vignette(image):
     # create vignette
     image.vignette(sigma=50, x=1, y=1)
 
+def loadDirt():
+    """Helper method for dirtTexture.
+    The dirt texture at its own size, decoded the first time it is needed."""
+    global dirtSource
+    if dirtSource is None:
+        dirtSource = wandImage(filename = DIRT_PATH)
+    return dirtSource
+
+def dirtTexture(width, height):
+    """Helper method for vintage.
+    The dirt texture resized to (width x height), kept for later calls.
+    Callers must not change or close it."""
+    size = (width, height)
+    if size in dirtTextures:
+        # mark as recently used
+        dirtTextures.move_to_end(size)
+        return dirtTextures[size]
+    dirt = loadDirt().clone()
+    # make size of image
+    dirt.resize(width, height)
+    dirtTextures[size] = dirt
+    # forget the least recently used sizes
+    while len(dirtTextures) > 1 and \
+          sum( w * h for w, h in dirtTextures ) > MAX_DIRT_PIXELS:
+        _, old = dirtTextures.popitem(last=False)
+        old.close()
+    return dirt
+
 def vintage(image):
     """Vintage filter emulating 70s, 80s photography.
-    Usage: filter.py vintage {image path}"""
+    Takes an optional seed, which fixes the angle of the blur; other
+    commands are ignored.
+    Usage: filter.py vintage {image path} {optional seed}"""
     # motion blur along image
     # random angle for blur between -90, -45, 0, 45, 90
-    v = randrange(-90, 90, 45)
+    blurSeed = seed
+    if commands and commands[0].lstrip('-').isdigit():
+        blurSeed = int(commands[0])
+    v = Random(blurSeed).randrange(-90, 90, 45)
     image.motion_blur(radius=4, sigma=8, angle=v)
 
     # composite dirt for grain effect
-    with wandImage(filename = "filter/dirt.png") as dirt:
-        # make size of image
-        dirt.resize(image.width, image.height)
-        image.composite(dirt)
+    image.composite(dirtTexture(image.width, image.height))
 
     # composite faded sepia image on top of orignal as blend
     with image.clone() as converted:
@@ -73,6 +159,22 @@ def hexToRGB(hex):
     # create tuple representing rgb
     return tuple(int(hex[i:i+2], 16) for i in (0, 2, 4))
 
+def getPaletteCache():
+    """Helper method for recolor.
+    The on-disk cache of clusterings, or None if it can't be used."""
+    global paletteCache
+    if paletteCache is None:
+        try:
+            paletteCache = PaletteCache()
+        except OSError:
+            paletteCache = False
+    return paletteCache
+
+def reusePreview():
+    """Helper method for the PIL filters.
+    Whether this is a full-resolution render following a preview."""
+    return previewState is not None and not previewState['proxy']
+
 def recolor(image):
     """Recolor filter recoloring reduced colors for striking effect.
     One example is the Obama "Change" image from 2008.
@@ -86,34 +188,96 @@ def recolor(image):
     rgbInput = []
     for c in commands:
         rgbInput.append(hexToRGB(c))
+    k = len(rgbInput)
+    # clusters only depend on the image and how it's clustered,
+    # so a cached clustering can be reused with any hex codes;
+    # frames of a sequence start from earlier frames instead
+    cache = getPaletteCache() if paletteTracker is None else None
+    labels = None
+    if cache:
+        # hashing the image is only worth it when there is a cache to look in
+        key = paletteKey(image, k=k, blur=2, bits=8, maxIter=MAX_ITER, tolerance=TOLERANCE,
+                         seeding=SEEDING, seed=seed, batchSize=batchSize, space=colorSpace)
+        labels = cache.get(key)
+    # a full-resolution render after a preview reuses the preview's clusters
+    if reusePreview():
+        labels = previewState['labels']
     # blur image to smooth out edges
-    result = image.filter(ImageFilter.GaussianBlur(2))
+    with stage('blur'):
+        result = image.filter(ImageFilter.GaussianBlur(2))
+    # a frame reuses the clusters of the frames before, or starts from them
+    initial = None
+    if paletteTracker is not None and labels is None:
+        labels, initial = paletteTracker.clusters(result)
     # recolor clusters of color as input colors
-    result = Recolor(result, len(rgbInput), rgbInput).image()
-    return result
+    recolored = Recolor(result, k, rgbInput, labels=labels, seed=seed,
+                        batchSize=batchSize, space=colorSpace, initial=initial)
+    if cache and labels is None:
+        cache.put(key, recolored.centers)
+    if paletteTracker is not None:
+        paletteTracker.update(recolored.centers)
+    if previewState is not None:
+        previewState['labels'] = recolored.centers
+    # drawn by several processes, the whole image is held anyway;
+    # otherwise it is drawn a band of rows at a time as it is saved
+    if jobs != 1:
+        return recolored.image(jobs)
+    return recolored
 
 def remap(image):
     """Remaps based on map. White parts become back image; everything
     else becomes front image.
-    Usage: filter.py noir {map image path} {front image path} {back image path}"""
+    Add "soft" to blend front and back by the map's grey levels instead.
+    Usage: filter.py noir {map image path} {front image path} {back image path} {optional soft}"""
     if len(commands) < 2:
         print("Need 3 images: Map, Front Image, Back Image")
         exit()
     map = image
-    front = Image.open(commands[0])
-    back = Image.open(commands[1])
-    result = Remap(map, front, back).image()
+    # front and back are shrunk to cover the map, so they need not be decoded whole
+    front = openImage(commands[0], map.size)
+    back = openImage(commands[1], map.size)
+    soft = len(commands) > 2 and commands[2] == 'soft'
+    # a full-resolution render after a preview reuses the preview's mask
+    mask = previewState['mask'] if reusePreview() else None
+    remapped = Remap(map, front, back, soft, mask)
+    if previewState is not None:
+        previewState['mask'] = remapped.mask()
+    result = remapped.image()
     return result
 
+def contrastTable(image, factor):
+    """Helper method for square.
+    The table every channel is looked up in to enhance the contrast of
+    image (a PIL image or an array of pixels) by factor, exactly as PIL's
+    ImageEnhance.Contrast does: away from the mean of the image's grey."""
+    total, n = 0, 0
+    for _, band in rowChunks(image):
+        band = band.astype(np.int64)
+        grey = (band[..., 0]*19595 + band[..., 1]*38470 + band[..., 2]*7471 + 0x8000) >> 16
+        total, n = total + int(grey.sum()), n + grey.size
+    mean = int(total / max(1, n) + 0.5)
+    return np.clip(mean + factor * (np.arange(256) - mean), 0, 255).astype(np.uint8)
+
 def square(image, style):
     """Changes the image based on a square size and style."""
     # increase contrast, s.t image reads better
-    image = ImageEnhance.Contrast(image).enhance(2.0)
+    with stage('contrast'):
+        lut = contrastTable(image, 2.0)
     # default size of square is 5x5 pixels
     if len(commands) == 0:
         square = 5
     else: square = int(commands[0])
-    result = Rehatch(image, square, '{}'.format(style)).image()
+    values = None
+    if reusePreview():
+        # a full-resolution render after a preview reuses the preview's values
+        values = previewState['values']
+    elif previewState is not None:
+        # squares of a preview cover the same part of the picture
+        square = max(1, round(square * previewState['scale']))
+    rehatched = Rehatch(image, square, '{}'.format(style), values, lut)
+    if previewState is not None:
+        previewState['values'] = rehatched.values()
+    result = rehatched.image(jobs)
     return result
 
 def pixelate(image):
@@ -133,9 +297,548 @@ def dots(image):
     Usage: filter.py dots {image path} {optional square size}"""
     return square(image, 'dots')
 
+def drawn(image):
+    """Helper method for pipeline.
+    Filters may return a filter object that draws its image when asked
+    (and can stream it to a file, see saveResult); draw it."""
+    if hasattr(image, 'stream'):
+        return image.image()
+    return image
+
+def toPIL(image):
+    """Helper method for pipeline.
+    Hand a wand image's pixels to PIL, without encoding them."""
+    image = drawn(image)
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(image))
+    with image:
+        pixels = np.array(image)
+    # greyscale images come out as (h x w x 1), which PIL won't take
+    if pixels.ndim == 3 and pixels.shape[2] == 1:
+        pixels = pixels[..., 0]
+    return Image.fromarray(pixels)
+
+def toWand(image):
+    """Helper method for pipeline.
+    Hand a PIL image's pixels to wand, without encoding them."""
+    image = drawn(image)
+    if isinstance(image, np.ndarray):
+        image = toPIL(image)
+    if not isinstance(image, Image.Image):
+        return image
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return wandImage.from_array(np.asarray(image))
+
+def runPipeline(stages, image):
+    """Apply (filterName, commands) stages in order to a decoded image.
+    Pixels are handed between wand and PIL in memory only when the next
+    stage needs the other library; square filters also take mapped pixels
+    as they are (see decode).  Returns the final wand or PIL image,
+    or a filter object that draws it (see drawn)."""
+    global commands
+    for filterName, filterCommands in stages:
+        commands = list(filterCommands)
+        #ImageMagick filters change the image in place
+        if filterName in wandFilters:
+            with stage('convert'):
+                image = toWand(image)
+            with stage(filterName):
+                globals()[filterName](image)
+        #K-Means(PIL) filters return a new image
+        else:
+            if not (filterName in arrayFilters and isinstance(image, np.ndarray)):
+                with stage('convert'):
+                    image = toPIL(image)
+            with stage(filterName):
+                image = globals()[filterName](image)
+    return image
+
+def pipeline(stages, imagePath, resultPath=None):
+    """Apply a sequence of (filterName, commands) stages to the image at
+    imagePath, decoding it once and encoding only the final result.
+    Saves the result in resultPath, by default in folder "results" as
+    "filterName1-filterName2_imageName", and returns the path it was saved to."""
+    if resultPath is None:
+        # get base name of image; ex: images/boris.jpeg => brois.jpeg
+        imageName = os.path.basename(imagePath)
+        names = '-'.join( filterName for filterName, _ in stages )
+        resultPath = 'results/{}_{}'.format(names, imageName)
+    saveResult(runPipeline(stages, decode(imagePath, stages[0][0])), resultPath)
+    return resultPath
+
+def decode(imagePath, filterName):
+    """Helper method for pipeline and sequence.
+    Decode the image at imagePath with the library filterName uses.
+    Square filters read uncompressed r-g-b(-a) images as the pixels
+    mapped from the file instead (see filter.source.mapPixels)."""
+    with stage('decode'):
+        if filterName in wandFilters:
+            return wandImage(filename = imagePath)
+        if filterName in arrayFilters:
+            px = mapPixels(imagePath)
+            if px is not None and px.shape[2] in (3, 4):
+                return px
+        return openImage(imagePath)
+
+def saveResult(result, resultPath):
+    """Helper method for pipeline and previewFilter.
+    Encode a wand or PIL image to resultPath, a path or a binary file.
+    Filter objects that stream their image are drawn as they are encoded;
+    they time the two as stages of their own."""
+    if hasattr(result, 'stream'):
+        result.stream(resultPath)
+        return
+    with stage('encode'):
+        if isinstance(result, Image.Image):
+            result.save(resultPath, format='png')
+        elif isinstance(resultPath, str):
+            with result:
+                result.save(filename = resultPath)
+        else:
+            with result:
+                result.format = 'png'
+                result.save(file = resultPath)
+
+def previewFilter(filterName, imagePath, filterCommands=(), size=PREVIEW_SIZE):
+    """Apply a filter to a copy of the image at imagePath no larger than
+    size x size, then to the full image, reusing what was found on the
+    copy (recolor's clusters, remap's mask, the values of square filters).
+    Saves "results/preview_filterName_imageName" and the usual result,
+    prints how long each took, and returns both paths."""
+    global previewState
+    imageName = os.path.basename(imagePath)
+    # the full image is only decoded once the preview is saved
+    with Image.open(imagePath) as header:
+        width = header.width
+    # the proxy is decoded at a reduced scale where the format allows it
+    proxy = openImage(imagePath, (size, size))
+    proxy.thumbnail((size, size))
+    stages = [ (filterName, filterCommands) ]
+    try:
+        previewState = { 'proxy': True, 'scale': proxy.width / width }
+        start = perf_counter()
+        result = runPipeline(stages, proxy)
+        print("Preview ({}x{}) in {:.2f}s".format(proxy.width, proxy.height,
+                                                  perf_counter() - start))
+        previewPath = 'results/preview_{}_{}'.format(filterName, imageName)
+        saveResult(result, previewPath)
+
+        previewState['proxy'] = False
+        start = perf_counter()
+        image = openImage(imagePath)
+        result = runPipeline(stages, image)
+        print("Full resolution ({}x{}) in {:.2f}s".format(image.width, image.height,
+                                                          perf_counter() - start))
+        resultPath = 'results/{}_{}'.format(filterName, imageName)
+        saveResult(result, resultPath)
+    finally:
+        previewState = None
+    return previewPath, resultPath
+
+def applyFilter(filterName, imagePath, filterCommands=()):
+    """Apply a filter to the image at imagePath with the given commands.
+    Saves the result in folder "results" as "filterName_imageName"
+    and returns the path it was saved to."""
+    return pipeline([ (filterName, filterCommands) ], imagePath)
+
+def filterOptions():
+    """Helper method for batch and serve.
+    The (seed, batchSize, colorSpace) options set on the command line,
+    for worker processes, which don't share this process's globals."""
+    return seed, batchSize, colorSpace
+
+def useOptions(options):
+    """Helper method for batch and serve.
+    Set the options returned by filterOptions in a worker process."""
+    global seed, batchSize, colorSpace
+    seed, batchSize, colorSpace = options
+
+def timedFilter(job):
+    """Helper method for batch.
+    Apply a (filterName, imagePath, commands, options) job and time it;
+    options are those of filterOptions.
+    Returns (filterName, imagePath, resultPath, seconds, error)."""
+    filterName, imagePath, filterCommands, options = job
+    useOptions(options)
+    start = perf_counter()
+    try:
+        resultPath, error = applyFilter(filterName, imagePath, filterCommands), None
+    # filters exit() on bad commands; report that instead of stopping the batch
+    except SystemExit:
+        resultPath, error = None, "filter exited"
+    except Exception as e:
+        resultPath, error = None, repr(e)
+    return filterName, imagePath, resultPath, perf_counter() - start, error
+
+def profiled(profilePath, name, imagePath, function, *args):
+    """Helper method for the command line.
+    Call function(*args), recording the time spent in every stage and the
+    work done, and save the trace as json to profilePath (if it is True, to
+    "results/profile_name_imageName.json").  Returns what function returned."""
+    if profilePath is True:
+        imageName = os.path.splitext(os.path.basename(imagePath))[0]
+        profilePath = 'results/profile_{}_{}.json'.format(name, imageName)
+    with tracing() as trace:
+        start = perf_counter()
+        result = function(*args)
+        seconds = perf_counter() - start
+    profile = { 'filter': name, 'image': imagePath, 'seconds': seconds,
+                'jobs': jobs, 'seed': seed, 'batchSize': batchSize, 'space': colorSpace }
+    profile.update(trace.asDict())
+    with open(profilePath, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print("Profile saved to {}".format(profilePath))
+    return result
+
+def findImages(pattern):
+    """Helper method for batch.
+    List the images in a directory, or the paths matching a glob."""
+    if os.path.isdir(pattern):
+        paths = [ os.path.join(pattern, name) for name in os.listdir(pattern) ]
+    else:
+        paths = glob(pattern)
+    return sorted( path for path in paths if os.path.isfile(path) and
+                   os.path.splitext(path)[1].lower() in imageExtensions )
+
+def batch(pattern, filterJobs, jobs=None):
+    """Apply every (filterName, commands) pair in filterJobs to every image
+    matching pattern, spread across a pool of jobs processes (default: one
+    per core).  Prints the time each image took, then a summary.
+    Returns the list of timedFilter results."""
+    options = filterOptions()
+    jobList = [ (filterName, imagePath, filterCommands, options)
+                for imagePath in findImages(pattern)
+                for filterName, filterCommands in filterJobs ]
+    results = []
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(timedFilter, jobList):
+            filterName, imagePath, resultPath, seconds, error = result
+            status = resultPath if error is None else "failed: {}".format(error)
+            print("{:>8.2f}s  {:<9} {}  {}".format(seconds, filterName, imagePath, status))
+            results.append(result)
+    wall = perf_counter() - start
+    failed = sum(1 for result in results if result[4] is not None)
+    busy = sum(result[3] for result in results)
+    print("{} jobs ({} failed) in {:.2f}s wall, {:.2f}s of filter time.".format(
+        len(results), failed, wall, busy))
+    return results
+
+def batchMain(argv):
+    """Command line for batch.
+    Usage: filter.py batch {image directory or glob} {filters or all}
+           [--jobs N] [--commands {other commands}]
+    Every filter may be given its own commands as in pipeline, e.g.
+    "pixelate:8" or "recolor:FBFAF6:929DA3:20101A"; with 'all', filters
+    given this way replace their entry.  --commands are fed to the
+    filters given without commands of their own."""
+    parser = ArgumentParser(prog='filter.py batch',
+                            description='Apply filters to many images in parallel.')
+    parser.add_argument('images', help='directory of images, or a glob')
+    parser.add_argument('filters', nargs='+',
+                        help="filter names, or 'all', each optionally with commands: "
+                             "filter:command:...")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--commands', nargs='*', default=[],
+                        help='other commands to feed to filters given without their own')
+    args = parser.parse_args(argv)
+    filterJobs = OrderedDict()
+    for filterText in args.filters:
+        if filterText == 'all':
+            for filterName in filters:
+                filterJobs.setdefault(filterName, None)
+            continue
+        filterName, *filterCommands = filterText.split(':')
+        if filterName not in filters:
+            print("The filter {} does not exsist.".format(filterName))
+            exit()
+        filterJobs[filterName] = filterCommands or None
+    batch(args.images, [ (filterName, args.commands if filterCommands is None else filterCommands)
+                         for filterName, filterCommands in filterJobs.items() ], args.jobs)
+
+def sequence(directory, filterName, filterCommands=(), outputDirectory=None, drift=DRIFT):
+    """Apply a filter to every frame in directory, in name order, reading
+    the next frames and writing the last ones while a frame is filtered.
+    recolor keeps one palette across frames: a frame reuses the clusters
+    of the frames before unless its colors drifted more than drift (a
+    share of pixels), and is then clustered starting from them.
+    Saves the frames as PNGs of the same names in outputDirectory (by
+    default "results/filterName_directoryName") and returns it."""
+    global paletteTracker
+    if outputDirectory is None:
+        name = os.path.basename(os.path.normpath(directory))
+        outputDirectory = 'results/{}_{}'.format(filterName, name)
+    os.makedirs(outputDirectory, exist_ok=True)
+    stages = [ (filterName, filterCommands) ]
+
+    def write(framePath, result):
+        name = os.path.splitext(os.path.basename(framePath))[0]
+        saveResult(result, os.path.join(outputDirectory, name + '.png'))
+
+    paletteTracker = PaletteTracker(drift)
+    start = perf_counter()
+    try:
+        frames = pipelined(findImages(directory), lambda path: decode(path, filterName),
+                           lambda image: runPipeline(stages, image), write)
+    finally:
+        paletteTracker = None
+    print("{} frames in {:.2f}s.".format(frames, perf_counter() - start))
+    return outputDirectory
+
+def sequenceMain(argv):
+    """Command line for sequence.
+    Usage: filter.py sequence {frame directory} {filter} [--drift X]
+           [--output {directory}] [--commands {other commands}]"""
+    parser = ArgumentParser(prog='filter.py sequence',
+                            description='Apply a filter to every frame of a sequence.')
+    parser.add_argument('frames', help='directory of frames')
+    parser.add_argument('filter', help='filter name')
+    parser.add_argument('--drift', type=float, default=DRIFT,
+                        help='share of pixels whose colors may change before recolor '
+                             'clusters a frame again (default: %(default)s)')
+    parser.add_argument('--output', default=None, help='directory to save the frames in')
+    parser.add_argument('--commands', nargs='*', default=[],
+                        help='other commands to feed to the filter')
+    args = parser.parse_args(argv)
+    if args.filter not in filters:
+        print("The filter {} does not exsist.".format(args.filter))
+        exit()
+    sequence(args.frames, args.filter, args.commands, args.output, args.drift)
+
+def parseStages(path):
+    """Helper method for serve.
+    Turn a request path like "/noir/dots:8" into (filterName, commands)
+    stages, or None if it names a filter that does not exsist."""
+    stages = []
+    for stageText in unquote(path).strip('/').split('/'):
+        filterName, *filterCommands = stageText.split(':')
+        if filterName not in filters:
+            return None
+        stages.append((filterName, filterCommands))
+    return stages or None
+
+def warmWorker(options):
+    """Helper method for serve.
+    Set the options of filterOptions, which a spawned worker doesn't
+    inherit, and load what filters need in every request before the first
+    one arrives: the dirt texture and the glyphs at the default square size."""
+    useOptions(options)
+    loadDirt()
+    for style in ('bucket', 'dots', 'pencil'):
+        atlas(style, 5)
+
+def serveRequest(job):
+    """Helper method for serve.
+    Apply (filterName, commands) stages to encoded image bytes with the
+    given seed.  Returns (status, PNG bytes or error message, seconds)."""
+    global seed
+    stages, imageBytes, requestSeed = job
+    seed = requestSeed
+    start = perf_counter()
+    try:
+        if stages[0][0] in wandFilters:
+            image = wandImage(blob = imageBytes)
+        else:
+            image = Image.open(io.BytesIO(imageBytes))
+            image.load()
+        result = runPipeline(stages, image)
+        output = io.BytesIO()
+        saveResult(result, output)
+        return 200, output.getvalue(), perf_counter() - start
+    # filters exit() on bad commands, or fail to read them as numbers
+    except (SystemExit, ValueError):
+        return 400, b"bad commands for this filter\n", perf_counter() - start
+    except Exception as e:
+        return 500, "{!r}\n".format(e).encode(), perf_counter() - start
+
+class FilterHandler(BaseHTTPRequestHandler):
+    """Handles POST /{filter:command:...}/{filter:command:...}?seed=N,
+    whose body is an encoded image, by answering with the filtered PNG."""
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        stages = parseStages(url.path)
+        if stages is None:
+            return self.reply(404, b"no such filter\n")
+        query = parse_qs(url.query)
+        try:
+            requestSeed = int(query['seed'][0]) if 'seed' in query else seed
+        except ValueError:
+            return self.reply(400, b"seed must be an integer\n")
+        imageBytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # refuse instead of queueing without bound
+        if not self.server.waiting.acquire(blocking=False):
+            return self.reply(503, b"too many requests waiting\n", {'Retry-After': '1'})
+        try:
+            future = self.server.pool.submit(serveRequest, (stages, imageBytes, requestSeed))
+            status, body, seconds = future.result()
+        # a worker died, or failed to start; the pool takes no more work
+        except BrokenProcessPool:
+            return self.reply(503, b"filter workers are down\n")
+        except Exception as e:
+            return self.reply(500, "{!r}\n".format(e).encode())
+        finally:
+            self.server.waiting.release()
+        kind = 'image/png' if status == 200 else 'text/plain'
+        self.reply(status, body, {'Content-Type': kind,
+                                  'X-Filter-Seconds': '{:.4f}'.format(seconds)})
+
+    def reply(self, status, body, headers=None):
+        """Send a response, the body a chunk at a time."""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for at in range(0, len(body), SEND_CHUNK):
+            self.wfile.write(view[at:at+SEND_CHUNK])
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'local'
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """An HTTP server listening on a Unix socket."""
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+def serve(host=SERVE_HOST, port=SERVE_PORT, socketPath=None, jobs=None,
+          maxWaiting=MAX_WAITING):
+    """Serve filters over HTTP on host:port, or on the Unix socket at
+    socketPath, until interrupted.  Requests are run by a pool of jobs
+    warm worker processes (default: one per core); at most maxWaiting
+    requests may wait for one, and the rest are answered 503."""
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = UnixHTTPServer(socketPath, FilterHandler)
+        address = socketPath
+    else:
+        server = ThreadingHTTPServer((host, port), FilterHandler)
+        address = 'http://{}:{}'.format(host, server.server_port)
+    jobs = jobs or os.cpu_count()
+    with server, ProcessPoolExecutor(max_workers=jobs, initializer=warmWorker,
+                                     initargs=(filterOptions(),)) as pool:
+        server.pool = pool
+        server.waiting = threading.BoundedSemaphore(jobs + maxWaiting)
+        print("Serving filters on {}".format(address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    if socketPath is not None:
+        os.remove(socketPath)
+
+def serveMain(argv):
+    """Command line for serve.
+    Usage: filter.py serve [--host H] [--port N | --socket PATH] [--jobs N]
+           [--max-waiting N]
+    --seed (the seed of requests that do not give one), --minibatch and
+    --space are read by the command line before serveMain is called.
+    Then, e.g.: curl --data-binary @crew.jpeg localhost:8765/noir/dots:8 > out.png"""
+    parser = ArgumentParser(prog='filter.py serve',
+                            description='Serve filters over HTTP from warm worker processes.')
+    parser.add_argument('--host', default=SERVE_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help='port to listen on')
+    parser.add_argument('--socket', default=None, help='listen on this Unix socket instead')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--max-waiting', type=int, default=MAX_WAITING,
+                        help='requests that may wait for a worker before 503s')
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.socket, args.jobs, args.max_waiting)
+
 if __name__ == "__main__":
+    # optional seed, for the same result on every run
+    if '--seed' in sys.argv:
+        at = sys.argv.index('--seed')
+        seed = int(sys.argv[at+1])
+        del sys.argv[at:at+2]
+
+    # optional mini-batch clustering, much faster on images with many colors
+    if '--minibatch' in sys.argv:
+        at = sys.argv.index('--minibatch')
+        batchSize = int(sys.argv[at+1])
+        del sys.argv[at:at+2]
+
+    # optional perceptual color space for clustering, e.g. --space lab
+    if '--space' in sys.argv:
+        at = sys.argv.index('--space')
+        colorSpace = sys.argv[at+1]
+        del sys.argv[at:at+2]
+        if colorSpace not in SPACES:
+            print("The color space {} does not exsist; use one of {}.".format(
+                colorSpace, ', '.join(SPACES)))
+            exit()
+
+    # batch, serve and sequence take the options above as well
+    if len(sys.argv) >= 2 and sys.argv[1] == 'batch':
+        batchMain(sys.argv[2:])
+        exit()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'serve':
+        serveMain(sys.argv[2:])
+        exit()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'sequence':
+        sequenceMain(sys.argv[2:])
+        exit()
+
+    # optional number of processes for drawing large images
+    if '--jobs' in sys.argv:
+        at = sys.argv.index('--jobs')
+        jobs = int(sys.argv[at+1])
+        del sys.argv[at:at+2]
+
+    # optional preview on a small copy before the full-resolution render
+    previewSize = None
+    if '--preview' in sys.argv:
+        at = sys.argv.index('--preview')
+        previewSize = PREVIEW_SIZE
+        if at+1 < len(sys.argv) and sys.argv[at+1].isdigit():
+            previewSize = int(sys.argv.pop(at+1))
+        del sys.argv[at]
+
+    # optional json trace of the time spent in every stage
+    profilePath = None
+    if '--profile' in sys.argv:
+        at = sys.argv.index('--profile')
+        profilePath = True
+        if at+1 < len(sys.argv) and sys.argv[at+1].endswith('.json'):
+            profilePath = sys.argv.pop(at+1)
+        del sys.argv[at]
+
     if len(sys.argv) < 3:
-        print("Usage: filter.py {filter} {image} {other commands}.")
+        print("Usage: filter.py {filter} {image} {other commands} [--jobs N] [--seed N] [--minibatch N] [--space rgb|lab|oklab] [--preview [size]] [--profile [file.json]].")
+        print("       filter.py batch {images} {all or filter:command:...} ... [--jobs N] [--commands ...] [--seed N] [--minibatch N] [--space ...]")
+        print("       filter.py serve [--port N | --socket PATH] [--jobs N] [--seed N] [--minibatch N] [--space ...]")
+        print("       filter.py sequence {frames} {filter} [--drift X] [--commands ...] [--seed N] [--minibatch N] [--space ...]")
+        print("       filter.py pipeline {image} {filter:command:...} {filter:command:...} ...")
+        exit()
+
+    # chain of filters on one image, e.g. pipeline crew.jpeg noir dots:8
+    if sys.argv[1] == 'pipeline':
+        stages = []
+        for stageText in sys.argv[3:]:
+            filterName, *filterCommands = stageText.split(':')
+            if filterName not in filters:
+                print("The filter {} does not exsist.".format(filterName))
+                exit()
+            stages.append((filterName, filterCommands))
+        if not stages:
+            print("A pipeline needs at least one filter.")
+            exit()
+        if profilePath:
+            names = '-'.join( filterName for filterName, _ in stages )
+            profiled(profilePath, names, sys.argv[2], pipeline, stages, sys.argv[2])
+        else:
+            pipeline(stages, sys.argv[2])
         exit()
 
     # get filter name & other commands for filter to use
@@ -156,26 +859,11 @@ if __name__ == "__main__":
         exit()
 
     # find the filter that user inputed and apply to image
-    commands = sys.argv[3:]
-    # get imageName to save it
-    imageName = os.path.basename(imagePath)
-    #ImageMagick filters
-    if (filterName == 'noir' or filterName == 'sepia' or
-        filterName == 'vintage'):
-        # get image
-        image = wandImage(filename = imagePath)
-        # do effects
-        locals()[filterName](image)
-        # get base name of image; ex: images/boris.jpeg => brois.jpeg
-        # then save filterd image in folder  "results" as "filterName_imageName"
-        image.save(filename = 'results/{}_{}'.format(filterName, imageName))
-
-    #K-Means(PIL) filters
+    if previewSize:
+        run, args = previewFilter, (filterName, imagePath, sys.argv[3:], previewSize)
     else:
-        # get image
-        image = Image.open(imagePath)
-        # get result from applying effects
-        result = locals()[filterName](image)
-        # get base name of image; ex: images/boris.jpeg => brois.jpeg
-        # then save filterd image in folder  "results" as "filterName_imageName"
-        result.save('results/{}_{}'.format(filterName, imageName), format='png')
+        run, args = applyFilter, (filterName, imagePath, sys.argv[3:])
+    if profilePath:
+        profiled(profilePath, filterName, imagePath, run, *args)
+    else:
+        run(*args)
@@ -0,0 +1,109 @@
+# An on-disk cache of cluster labels.
+"""A cache that keeps the labels of k-means clusterings on disk.
+
+Clustering an image is the slow part of recoloring it, and the labels only
+depend on the image and the clustering parameters, not on the colors they
+are replaced with.  A "PaletteCache" stores labels under a key built by
+"paletteKey" from a hash of the image's pixels and every parameter that
+affects the clustering, so re-rendering the same photo with new colors can
+skip clustering entirely.
+
+Entries are small .npy files.  Reading an entry marks it as recently used;
+when the cache grows past "maxBytes", the least recently used entries are
+removed until it fits again.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+__all__ = ['PaletteCache', 'imageHash', 'paletteKey']
+
+# default location and size of the cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'artistic-after-effects')
+MAX_BYTES = 64 << 20
+
+def imageHash(img):
+    """A hex digest of an image's mode, size and pixels."""
+    h = hashlib.sha1()
+    h.update('{} {}x{}'.format(img.mode, img.width, img.height).encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def paletteKey(img, **parameters):
+    """The cache key for clustering img with the given parameters,
+    e.g. paletteKey(img, k=4, blur=2, bits=8)."""
+    h = hashlib.sha1(imageHash(img).encode())
+    h.update(repr(sorted(parameters.items())).encode())
+    return h.hexdigest()
+
+class PaletteCache(object):
+    """Cluster labels stored on disk, evicted least recently used first."""
+    __slots__ = ['_dir', '_maxBytes']
+
+    def __init__(self, directory=CACHE_DIR, maxBytes=MAX_BYTES):
+        self._dir = directory
+        self._maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        """The directory entries are kept in."""
+        return self._dir
+
+    def _path(self, key):
+        return os.path.join(self._dir, key + '.npy')
+
+    def get(self, key):
+        """The labels stored under key, as a tuple of tuples, or None."""
+        path = self._path(key)
+        try:
+            labels = np.load(path)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used; another process may have evicted it since
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return tuple( tuple(label) for label in labels.tolist() )
+
+    def put(self, key, labels):
+        """Store labels under key, then evict entries if over size.
+        Labels that can't be stored (e.g. the directory was removed) are
+        not cached."""
+        path = self._path(key)
+        # write to a temporary file first, so readers never see half an entry
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                np.save(f, np.asarray(labels))
+            os.replace(temporary, path)
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.npy'):
+                # another process may remove entries as we go
+                try:
+                    stat = os.stat(os.path.join(self._dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self._dir, name))
+            except OSError:
+                pass
+            total -= size
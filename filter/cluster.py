@@ -24,10 +24,37 @@ cluster index.
 The "variance" property returns the sum of the squares of the distances
 between values and their cluster's label.
 
+The "recluster" method returns a new clustering of the same values, labeled
+with the means of the current clusters.  The "refine" function repeats this
+(Lloyd's algorithm) until the variance stops improving.
+
 The "findClustering" function produces a tight k-clustering for a sequence
 of values, provided appropriate functions for computing distance and mean.
+The first labels are chosen by a seeding strategy: at random, by k-means++
+("seedPlusPlus") or by farthest point ("seedFarthest"), or are given, e.g.
+the labels of an earlier clustering of similar values (a warm start).
+The "mergeClusters" function coarsens weighted labels into fewer clusters.
+If no functions are given, the values are taken to be equal-length numeric
+vectors (e.g. r-g-b tuples) and are clustered by the "ArrayClustering" engine,
+which stores them as rows of a numpy array and measures Euclidean distance to
+all k labels at once.
 """
-__all__ = ['Clustering', 'findClustering']
+from time import perf_counter
+
+import numpy as np
+
+__all__ = ['Clustering', 'ArrayClustering', 'findClustering', 'refine',
+           'mergeClusters', 'seedRandom', 'seedPlusPlus', 'seedFarthest']
+
+# number of rows classified at a time; bounds the (rows x k x d) temporary
+CHUNK = 1 << 16
+# default limits on Lloyd iterations in refine
+MAX_ITER = 100
+TOLERANCE = 1e-4
+# defaults for mini-batch clustering: values drawn per iteration, and how
+# many iterations in a row may fail to improve before stopping
+BATCH_SIZE = 1024
+PATIENCE = 10
 
 class Clustering(object):
     __slots__ = ['_mean', '_dist', '_label', '_cluster']
@@ -87,6 +114,11 @@ class Clustering(object):
 
         return closest
 
+    def classifyAll(self, values):
+        """Return an array holding the index of the closest label for each
+        of values."""
+        return np.array([ self.classify(v) for v in values ], dtype=np.intp)
+
     @property
     def variance(self):
         """The sum of squared distances from values to their labels."""
@@ -107,19 +139,15 @@ class Clustering(object):
         clusters."""
 
         # collect all the data into a list
-        # get every cluster tuple into list
-        clusterList = [ value for value in self.cluster ]
-
-        # compute the means of the current clusters
-        # get mean of every cluster tuple in previous list
-        meanList = [ self._mean(cluster) for cluster in clusterList ]
+        data = [ value for cluster in self.cluster for value in cluster ]
 
-        # set label and clusters equal to the two lists we just made
-        self._label = tuple(meanList)
-        self._cluster = tuple(clusterList)
+        # compute the means of the current clusters;
+        # an empty cluster keeps its label
+        meanList = [ self._mean(cluster) if cluster else label
+                     for cluster, label in zip(self.cluster, self.label) ]
 
         # return a *new* clustering of the data labeled with current means
-        return self   # this is *not* correct; it's simply this clustering
+        return Clustering(data, meanList, self._mean, self._dist)
 
     def __str__(self):
         """Printable version of c."""
@@ -129,29 +157,338 @@ class Clustering(object):
     def __repr__(self):
         return str(self)
 
-# A factory that produces good clusterings.
-def findClustering(vals,k, meanFunction, distFunction):
-    """Generates a clustering of from a collection of data."""
-    from random import shuffle
+class ArrayClustering(Clustering):
+    """A clustering of numeric vectors held as rows of an (N,d) numpy array.
+    Distances are Euclidean and means are component-wise (floored, if the
+    data are integers), so no callbacks are needed and every value is
+    classified against all k labels in one batched operation.
+    If weights are given, each row counts as that many copies of its value
+    in means and variance (e.g. a color and its number of pixels)."""
+    __slots__ = ['_data', '_weights', '_centers', '_assign']
+
+    def __init__(self, data, labels, weights=None):
+        # no callbacks: distance and mean are computed on arrays
+        self._mean = None
+        self._dist = None
+        self._data = data
+        self._weights = weights
+        self._setLabels(labels)
+        # classify all the data at once
+        self._assign = self.classifyAll(data)
+        # clusters are only materialized as tuples if asked for
+        self._cluster = None
+
+    def _setLabels(self, centers):
+        """Remember the labels both as an array and as a tuple of tuples."""
+        self._centers = np.asarray(centers, dtype=self._data.dtype).reshape(-1, self._data.shape[1])
+        self._label = tuple( tuple(c) for c in self._centers.tolist() )
 
-    # collect data, shuffle it, use k of the values as labels:
-    vals = list(vals)
-    shuffle(vals)
-    labels = vals[:k]
+    @property
+    def cluster(self):
+        """A tuple of k clusters.  Each cluster is a tuple of data values."""
+        if self._cluster is None:
+            self._cluster = tuple( tuple(map(tuple, self._data[self._assign == i].tolist()))
+                                   for i in range(self.k) )
+        return self._cluster
 
-    # build the cluster
-    c = Clustering(vals, labels, meanFunction, distFunction)
-    v = c.variance
+    @property
+    def weights(self):
+        """The array of weights, one per row of data, or None."""
+        return self._weights
+
+    @property
+    def assignment(self):
+        """The array of cluster indices, one per row of data."""
+        return self._assign
+
+    def _distances(self, rows):
+        """The (rows x k) array of squared distances from rows to labels."""
+        # |r-c|^2 = |r|^2 - 2 r.c + |c|^2, so the bulk of the work is one
+        # matrix product; small integers (like colors) stay exact in float64
+        rows = rows.astype(np.float64)
+        centers = self._centers.astype(np.float64)
+        cross = rows @ centers.T
+        return (rows * rows).sum(axis=1)[:, None] - 2 * cross + (centers * centers).sum(axis=1)
+
+    def classify(self, v):
+        """Return the index of the cluster whose label is closest to v."""
+        # a single value is cheaper to compare in plain Python;
+        # squared distances order the labels the same way distances do
+        closest, closestDistance = 0, None
+        for i, label in enumerate(self._label):
+            distance = sum((a - b) * (a - b) for a, b in zip(label, v))
+            if closestDistance is None or distance < closestDistance:
+                closest, closestDistance = i, distance
+        return closest
 
-    # keep generating clusters until the variance stops decreasing
-    while True:
+    def classifyAll(self, values):
+        """Return an array holding the index of the closest label for each
+        row of values.  Ties go to the lower index, as in classify."""
+        values = np.asarray(values).reshape(-1, self._data.shape[1])
+        result = np.empty(len(values), dtype=np.intp)
+        for start in range(0, len(values), CHUNK):
+            rows = values[start:start+CHUNK]
+            result[start:start+CHUNK] = self._distances(rows).argmin(axis=1)
+        return result
+
+    @property
+    def variance(self):
+        """The sum of squared distances from values to their labels."""
+        diff = self._data.astype(np.float64) - self._centers[self._assign]
+        squares = (diff * diff).sum(axis=1)
+        if self._weights is not None:
+            return float(squares @ self._weights)
+        return float(squares.sum())
+
+    def _means(self):
+        """The array of component-wise means of the current clusters.
+        Empty clusters are given the values farthest from their labels."""
+        k, d = self.k, self._data.shape[1]
+        w = self._weights
+        counts = np.bincount(self._assign, weights=w, minlength=k)
+        sums = np.empty((k, d), dtype=np.float64)
+        for j in range(d):
+            column = self._data[:, j] if w is None else self._data[:, j] * w
+            sums[:, j] = np.bincount(self._assign, weights=column, minlength=k)
+        empty = counts == 0
+        counts[empty] = 1
+        if np.issubdtype(self._data.dtype, np.integer):
+            means = sums // counts[:, None]
+        else:
+            means = sums / counts[:, None]
+        if empty.any():
+            diff = self._data.astype(np.float64) - self._centers[self._assign]
+            farthest = np.argsort(-(diff * diff).sum(axis=1), kind='stable')
+            means[empty] = self._data[farthest[:empty.sum()]]
+        return means
+
+    def recluster(self):
+        """Generate a new clustering using means from the current clustering.
+        This version uses current centers to classify all the data into new
+        clusters."""
+        # reclassify all the data against the means of the current clusters
+        return ArrayClustering(self._data, self._means(), self._weights)
+
+def refine(c, maxIter=MAX_ITER, tolerance=TOLERANCE, callback=None):
+    """Run Lloyd iterations on clustering c and return the best clustering.
+    Stops after maxIter iterations, when the variance stops decreasing, or
+    when it decreases by no more than tolerance (relative to the previous
+    variance).  If given, callback(iteration, variance, seconds) is called
+    after every iteration with the new variance and the time it took."""
+    v = c.variance
+    for iteration in range(1, maxIter+1):
+        start = perf_counter()
         # try to improve clustering
         nextC = c.recluster()
         nextV = nextC.variance
+        if callback is not None:
+            callback(iteration, nextV, perf_counter() - start)
         # quit when improvement fails
         if nextV >= v:
             break
         # otherwise, go with new clustering
+        improvement = (v - nextV) / v
         c = nextC
         v = nextV
+        # quit when improvement is too small to be worth another pass
+        if improvement <= tolerance:
+            break
     return c
+
+def mergeClusters(labels, weights, k, **options):
+    """Merge a weighted set of labels into k new labels.
+    Pairs of labels are agglomerated (cheapest increase in variance first)
+    until k remain, then refined by weighted Lloyd iterations that start
+    from the merged labels; options are passed to refine.
+    Returns the (k,d) array of new labels and, for every old label, the
+    index of the new label it was merged into."""
+    labels = np.asarray(labels, dtype=np.float64).reshape(len(labels), -1)
+    weights = np.asarray(weights, dtype=np.float64)
+    centers, mass = labels.copy(), weights.copy()
+    alive = np.ones(len(labels), dtype=bool)
+    while alive.sum() > k:
+        # cost of merging each pair: the variance it would add
+        diff = centers[:, None, :] - centers[None, :, :]
+        both = mass[:, None] + mass[None, :]
+        scale = np.divide(mass[:, None] * mass[None, :], both,
+                          out=np.zeros_like(both), where=both > 0)
+        cost = scale * (diff * diff).sum(axis=2)
+        cost[~alive, :] = np.inf
+        cost[:, ~alive] = np.inf
+        np.fill_diagonal(cost, np.inf)
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        # merge j into i
+        if both[i, j] > 0:
+            centers[i] = (mass[i]*centers[i] + mass[j]*centers[j]) / both[i, j]
+        mass[i] += mass[j]
+        alive[j] = False
+    # warm-start Lloyd iterations from the merged labels
+    c = refine(ArrayClustering(labels, centers[alive], weights), **options)
+    return c._centers, c.assignment
+
+def seedRandom(data, k, weights, rng):
+    """Seeding for findClustering: k distinct values chosen at random."""
+    return data[rng.permutation(len(data))[:k]]
+
+def _seedSpread(data, k, weights, pick):
+    """Helper method for seedPlusPlus and seedFarthest.
+    Choose labels one at a time; pick(scores) returns the index of the next
+    label, where scores are weighted squared distances to the closest label
+    so far.  Stops early if every value is already a label."""
+    x = data.astype(np.float64)
+    w = np.ones(len(x)) if weights is None else weights
+    chosen = [ pick(w) ]
+    d2 = ((x - x[chosen[0]]) ** 2).sum(axis=1)
+    while len(chosen) < k:
+        scores = w * d2
+        if not scores.any():
+            break
+        chosen.append(pick(scores))
+        d2 = np.minimum(d2, ((x - x[chosen[-1]]) ** 2).sum(axis=1))
+    return data[chosen]
+
+def seedPlusPlus(data, k, weights, rng):
+    """Seeding for findClustering: k-means++.  Each label is chosen with
+    probability proportional to its (weighted) squared distance to the
+    labels chosen before it."""
+    return _seedSpread(data, k, weights,
+                       lambda scores: rng.choice(len(scores), p=scores / scores.sum()))
+
+def seedFarthest(data, k, weights, rng):
+    """Seeding for findClustering: farthest point.  Starts from the heaviest
+    value, then always takes the value with the greatest weighted squared
+    distance to the labels so far.  Does not depend on rng."""
+    return _seedSpread(data, k, weights, lambda scores: int(np.argmax(scores)))
+
+# seeding strategies by name; a function with the same arguments also works
+SEEDINGS = { 'random': seedRandom, 'kmeans++': seedPlusPlus, 'farthest': seedFarthest }
+SEEDING = 'kmeans++'
+
+def _seedLabels(seeding, data, k, weights, rng):
+    """Helper method for the array engines.
+    The first labels: chosen by seeding, a name in SEEDINGS or a function
+    like them, or seeding itself if it is a (k,d) array of labels."""
+    if isinstance(seeding, str):
+        seeding = SEEDINGS[seeding]
+    if callable(seeding):
+        return seeding(data, k, weights, rng)
+    return np.asarray(seeding).reshape(len(seeding), -1)
+
+def _findArrayClustering(vals, k, weights=None, seeding=SEEDING, seed=None, **options):
+    """Generates an ArrayClustering of a collection of numeric vectors."""
+    # collect data into an (N,d) array
+    if isinstance(vals, np.ndarray):
+        data = vals.reshape(len(vals), -1)
+    else:
+        data = np.array([ tuple(v) for v in vals ])
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+    # choose k of the values as labels
+    labels = _seedLabels(seeding, data, k, weights, np.random.default_rng(seed))
+
+    # build the cluster and improve it
+    return refine(ArrayClustering(data, labels, weights), **options)
+
+def _findMiniBatchClustering(vals, k, weights=None, seeding=SEEDING, seed=None,
+                             batchSize=BATCH_SIZE, maxIter=MAX_ITER, tolerance=TOLERANCE,
+                             patience=PATIENCE, callback=None):
+    """Generates an ArrayClustering by mini-batch k-means.
+    Every iteration draws batchSize values (in proportion to their weights)
+    and moves each label toward the mean of the values it attracts, by a
+    step that shrinks as the label gathers more values.  Stops after
+    maxIter iterations, or once the running average of the batch variance
+    has failed to improve by more than tolerance (relative) patience
+    times in a row.  Only the final clustering classifies all the data.
+    If given, callback(iteration, variance, seconds) is called after every
+    iteration with the running average of the batch variance."""
+    if isinstance(vals, np.ndarray):
+        data = vals.reshape(len(vals), -1)
+    else:
+        data = np.array([ tuple(v) for v in vals ])
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    # drawing a value is a binary search in the cumulative weights
+    cumulative = np.cumsum(weights if weights is not None else np.ones(len(data)))
+    def draw(n):
+        return np.searchsorted(cumulative, rng.random(n) * cumulative[-1], side='right')
+
+    # seed from a sample; the sample is already weighted
+    sample = data[draw(min(len(data), 4 * batchSize))]
+    centers = _seedLabels(seeding, sample, k, None, rng).astype(np.float64)
+    k = len(centers)
+    counts = np.zeros(k)
+    average, stale = None, 0
+    for iteration in range(1, maxIter+1):
+        start = perf_counter()
+        batch = data[draw(batchSize)].astype(np.float64)
+        # classify the batch against the current labels
+        distances = (batch * batch).sum(axis=1)[:, None] - 2 * batch @ centers.T \
+                    + (centers * centers).sum(axis=1)
+        assign = distances.argmin(axis=1)
+        variance = float(distances[np.arange(len(batch)), assign].sum())
+        # move every label toward the mean of its values in the batch
+        m = np.bincount(assign, minlength=k)
+        sums = np.stack([ np.bincount(assign, weights=batch[:, j], minlength=k)
+                          for j in range(batch.shape[1]) ], axis=1)
+        counts += m
+        moved = m > 0
+        centers[moved] += (sums[moved] - m[moved, None] * centers[moved]) / counts[moved, None]
+        # stop when the running batch variance stops improving
+        if average is None:
+            average = variance
+        else:
+            nextAverage = 0.7 * average + 0.3 * variance
+            if average - nextAverage <= tolerance * average:
+                stale += 1
+            else:
+                stale = 0
+            average = nextAverage
+        if callback is not None:
+            callback(iteration, average, perf_counter() - start)
+        if stale >= patience:
+            break
+
+    # one full assignment with the final labels
+    if np.issubdtype(data.dtype, np.integer):
+        centers = np.floor(centers)
+    return ArrayClustering(data, centers, weights)
+
+# A factory that produces good clusterings.
+def findClustering(vals,k, meanFunction=None, distFunction=None,
+                   maxIter=MAX_ITER, tolerance=TOLERANCE, callback=None,
+                   weights=None, seeding=None, seed=None, batchSize=None):
+    """Generates a clustering of from a collection of data.
+    Without a meanFunction and distFunction the values must be numeric
+    vectors, and the batched ArrayClustering engine is used; only this
+    engine accepts per-value weights and seeding strategies other than
+    'random' (see SEEDINGS; by default it uses SEEDING, the callback
+    engine random seeding).  The array engine also takes a (k,d) array of
+    labels as seeding, to start from.  Runs with the same seed give the
+    same clustering.
+    The maxIter, tolerance and callback options are passed to refine.
+    If batchSize is given, the array engine runs mini-batch k-means on
+    samples of that many values instead, so its cost does not grow with
+    the number of values (see _findMiniBatchClustering)."""
+    from random import Random
+
+    options = dict(maxIter=maxIter, tolerance=tolerance, callback=callback)
+    if seeding is None:
+        seeding = SEEDING if meanFunction is None and distFunction is None else 'random'
+    if meanFunction is None and distFunction is None and batchSize:
+        return _findMiniBatchClustering(vals, k, weights, seeding, seed,
+                                        batchSize, **options)
+    if meanFunction is None and distFunction is None:
+        return _findArrayClustering(vals, k, weights, seeding, seed, **options)
+    if weights is not None:
+        raise ValueError("weights require the array engine (no meanFunction or distFunction)")
+    if not isinstance(seeding, str) or seeding != 'random':
+        raise ValueError("only random seeding works with meanFunction and distFunction")
+
+    # collect data, shuffle it, use k of the values as labels:
+    vals = list(vals)
+    Random(seed).shuffle(vals)
+    labels = vals[:k]
+
+    # build the cluster and improve it
+    return refine(Clustering(vals, labels, meanFunction, distFunction), **options)
@@ -0,0 +1,175 @@
+# Conversions between r-g-b colors and perceptual color spaces.
+"""Convert r-g-b colors to and from CIELAB and OKLab.
+
+Distances between colors in these spaces follow how different colors look
+much more closely than distances between their r-g-b values do, so k
+clusters found in them make a better palette than k clusters found in
+r-g-b.  The spaces are named 'rgb' (no conversion), 'lab' and 'oklab'.
+
+"toSpace(colors, space)" converts an (N,3) array of 0-255 r-g-b colors;
+"fromSpace(values, space)" converts back to 0-255 r-g-b colors, clipping
+any that sRGB can't show.  Undoing sRGB's gamma is a lookup in a table of
+the 256 possible channel values, built the first time it is needed.
+
+"findColorClustering" clusters r-g-b colors in a space, and returns a
+"ColorClustering": a clustering whose labels are r-g-b colors and whose
+classifyAll takes r-g-b colors, so it stands in for an ArrayClustering.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from filter.cluster import ArrayClustering, findClustering
+
+__all__ = ['SPACES', 'toSpace', 'fromSpace', 'lightness', 'ColorClustering',
+           'findColorClustering', 'labelClustering']
+
+SPACES = ('rgb', 'lab', 'oklab')
+
+# linear sRGB to CIE XYZ, and the D65 white point
+RGB_TO_XYZ = np.array([ [0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041] ])
+WHITE_XYZ = np.array([0.95047, 1.0, 1.08883])
+# linear sRGB to LMS cone responses, and cube-rooted LMS to OKLab
+RGB_TO_LMS = np.array([ [0.4122214708, 0.5363325363, 0.0514459929],
+                        [0.2119034982, 0.6806995451, 0.1073969566],
+                        [0.0883024619, 0.2817188376, 0.6299787005] ])
+LMS_TO_OKLAB = np.array([ [0.2104542553, 0.7936177850, -0.0040720468],
+                          [1.9779984951, -2.4285922050, 0.4505937099],
+                          [0.0259040371, 0.7827717662, -0.8086757660] ])
+# where CIELAB's cube root gives way to a straight line
+EPSILON = (6/29) ** 3
+
+@lru_cache(maxsize=None)
+def linearTable():
+    """The linear light of every 8-bit sRGB channel value."""
+    c = np.arange(256) / 255
+    return np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+
+def toLinear(colors):
+    """Helper method for toSpace.
+    The linear light of an (N,3) array of 0-255 r-g-b colors."""
+    colors = np.asarray(colors)
+    if np.issubdtype(colors.dtype, np.integer):
+        return linearTable()[colors]
+    # colors between the 256 steps are interpolated
+    return np.interp(colors, np.arange(256), linearTable())
+
+def fromLinear(linear):
+    """Helper method for fromSpace.
+    The 0-255 r-g-b colors of an (N,3) array of linear light."""
+    linear = np.clip(linear, 0, 1)
+    c = np.where(linear <= 0.0031308, 12.92 * linear, 1.055 * linear ** (1/2.4) - 0.055)
+    return np.clip(np.rint(c * 255), 0, 255).astype(np.uint8)
+
+def toSpace(colors, space):
+    """Convert an (N,3) array of 0-255 r-g-b colors to space."""
+    if space == 'rgb':
+        return np.asarray(colors)
+    linear = toLinear(colors)
+    if space == 'lab':
+        xyz = linear @ RGB_TO_XYZ.T / WHITE_XYZ
+        f = np.where(xyz > EPSILON, np.cbrt(xyz), xyz / (3 * (6/29) ** 2) + 4/29)
+        return np.stack([ 116 * f[:, 1] - 16,
+                          500 * (f[:, 0] - f[:, 1]),
+                          200 * (f[:, 1] - f[:, 2]) ], axis=1)
+    if space == 'oklab':
+        return np.cbrt(linear @ RGB_TO_LMS.T) @ LMS_TO_OKLAB.T
+    raise ValueError("unknown color space {!r}".format(space))
+
+def fromSpace(values, space):
+    """Convert an (N,3) array of values in space to 0-255 r-g-b colors."""
+    values = np.asarray(values, dtype=np.float64)
+    if space == 'rgb':
+        return np.clip(np.floor(values), 0, 255).astype(np.uint8)
+    if space == 'lab':
+        fy = (values[:, 0] + 16) / 116
+        f = np.stack([ fy + values[:, 1] / 500, fy, fy - values[:, 2] / 200 ], axis=1)
+        xyz = np.where(f > 6/29, f ** 3, 3 * (6/29) ** 2 * (f - 4/29)) * WHITE_XYZ
+        return fromLinear(xyz @ np.linalg.inv(RGB_TO_XYZ).T)
+    if space == 'oklab':
+        lms = (values @ np.linalg.inv(LMS_TO_OKLAB).T) ** 3
+        return fromLinear(lms @ np.linalg.inv(RGB_TO_LMS).T)
+    raise ValueError("unknown color space {!r}".format(space))
+
+def lightness(colors, space):
+    """How light each of an (N,3) array of 0-255 r-g-b colors looks in
+    space; in 'rgb', the average of the channels."""
+    if space == 'rgb':
+        return np.asarray(colors).mean(axis=1)
+    return toSpace(colors, space)[:, 0]
+
+class ColorClustering(object):
+    """A clustering of r-g-b colors made in another color space.
+    Labels are r-g-b colors, and colors are converted to the space before
+    they are classified."""
+    __slots__ = ['_clust', '_space', '_label']
+
+    def __init__(self, clustering, space):
+        self._clust = clustering
+        self._space = space
+        rgb = fromSpace(np.asarray(clustering.label), space)
+        self._label = tuple( tuple(label) for label in rgb.tolist() )
+
+    @property
+    def space(self):
+        """The color space colors were clustered in."""
+        return self._space
+
+    @property
+    def clustering(self):
+        """The clustering of the colors in the space."""
+        return self._clust
+
+    @property
+    def label(self):
+        """The tuple of labels, as r-g-b colors."""
+        return self._label
+
+    @property
+    def k(self):
+        """The number of clusters."""
+        return self._clust.k
+
+    @property
+    def weights(self):
+        """The weight of every value, or None."""
+        return self._clust.weights
+
+    @property
+    def assignment(self):
+        """The index of the cluster of every clustered color."""
+        return self._clust.assignment
+
+    @property
+    def variance(self):
+        """The weighted sum of squared distances in the space."""
+        return self._clust.variance
+
+    def classify(self, v):
+        """Return the index of the cluster whose label is closest to the
+        r-g-b color v."""
+        return self._clust.classify(tuple(toSpace(np.array([v]), self._space)[0]))
+
+    def classifyAll(self, values):
+        """Return an array holding the index of the closest label for each
+        of an (N,3) array of r-g-b colors."""
+        return self._clust.classifyAll(toSpace(values, self._space))
+
+def findColorClustering(colors, k, space='rgb', **options):
+    """Cluster an (N,3) array of 0-255 r-g-b colors into k clusters in
+    space.  The options are passed to findClustering."""
+    if space == 'rgb':
+        return findClustering(colors, k, **options)
+    return ColorClustering(findClustering(toSpace(colors, space), k, **options), space)
+
+def labelClustering(centers, space='rgb'):
+    """A clustering with the given centers in space (the label of a
+    clustering's clustering, for a ColorClustering), for classifying
+    colors against centers found earlier."""
+    if space == 'rgb':
+        centers = np.asarray(centers, dtype=np.uint8)
+        return ArrayClustering(centers, centers)
+    centers = np.asarray(centers, dtype=np.float64)
+    return ColorClustering(ArrayClustering(centers, centers), space)
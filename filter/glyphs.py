@@ -0,0 +1,51 @@
+# Cached glyph atlases for Rehatch.
+"""Glyphs for the value scales of Rehatch, loaded once per process.
+
+Every style is a folder "filter/{style}" of ten images, 0.png (darkest) to
+9.png (lightest).  "glyphs(style)" opens them the first time the style is
+used and keeps them for the life of the process.
+
+"atlas(style, square)" returns an (11 x square x square x 4) array whose
+entry v is what value v looks like when its glyph is pasted on white; entry
+10 (white) is left blank.  Indexing it with an array of values stamps every
+square at once.  The most recently used atlases are kept, so workers that
+switch between square sizes don't resize glyphs on every job.
+"""
+from functools import lru_cache
+import os
+
+from PIL import Image
+import numpy as np
+
+__all__ = ['glyphs', 'atlas']
+
+# folder holding the style folders
+GLYPH_DIR = os.path.dirname(os.path.abspath(__file__))
+# number of (style, square) atlases kept
+MAX_ATLASES = 32
+
+WHITE = (255,255,255)
+
+@lru_cache(maxsize=None)
+def glyphs(style):
+    """The tuple of ten glyph images of a style, darkest first."""
+    result = []
+    for value in range(10):
+        with Image.open(os.path.join(GLYPH_DIR, style, "{}.png".format(value))) as glyph:
+            result.append(glyph.convert("RGBA"))
+    return tuple(result)
+
+@lru_cache(maxsize=MAX_ATLASES)
+def atlas(style, square):
+    """The (11 x square x square x 4) array of every value of a style drawn
+    on white at square x square pixels; value 10 is left white."""
+    tiles = np.empty((11, square, square, 4), dtype=np.uint8)
+    for value in range(11):
+        tile = Image.new("RGBA", (square, square), WHITE)
+        if value != 10:
+            hatch = glyphs(style)[value].resize((square, square), Image.NEAREST)
+            tile.paste(hatch, (0, 0), mask=hatch)
+        tiles[value] = np.asarray(tile)
+    # shared by every caller, so it must not be changed
+    tiles.flags.writeable = False
+    return tiles
@@ -0,0 +1,102 @@
+# Timing the stages of a filter.
+"""Record how long each stage of a filter takes, and how much it did.
+
+Code that does a distinct piece of work wraps it in "stage":
+
+    with stage('cluster'):
+        clustering = findClustering(colors, k)
+
+Nothing is recorded unless a "Trace" is active.  "tracing()" makes a new
+trace the active one for the duration of a with block:
+
+    with tracing() as trace:
+        applyFilter('recolor', 'crew.jpeg', hexCodes)
+    print(trace.stages)
+
+A stage entered more than once adds up its seconds and counts its calls.
+Stages may be nested; the seconds of a stage include those of the stages
+inside it.  "count(name, n)" adds n to a counter of the active trace, for
+the amount of work done, such as clustering iterations or pixels drawn.
+When no trace is active, a stage or a count costs one global lookup.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+
+__all__ = ['Trace', 'stage', 'count', 'tracing', 'activeTrace']
+
+# the trace stages are recorded in; None when nothing is recorded
+_trace = None
+
+class Trace(object):
+    """The seconds spent in, and number of calls of, every stage of a run,
+    and the counters of the work done."""
+    __slots__ = ['_seconds', '_calls', '_counters']
+
+    def __init__(self):
+        self._seconds = OrderedDict()
+        self._calls = OrderedDict()
+        self._counters = OrderedDict()
+
+    def add(self, name, seconds):
+        """Record one call of stage name that took seconds."""
+        self._seconds[name] = self._seconds.get(name, 0.0) + seconds
+        self._calls[name] = self._calls.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        """Add n to counter name."""
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    @property
+    def stages(self):
+        """A dictionary of the seconds spent in every stage, in the order
+        stages were first entered."""
+        return OrderedDict(self._seconds)
+
+    @property
+    def calls(self):
+        """A dictionary of the number of calls of every stage."""
+        return OrderedDict(self._calls)
+
+    @property
+    def counters(self):
+        """A dictionary of every counter."""
+        return OrderedDict(self._counters)
+
+    def asDict(self):
+        """The trace as a dictionary, ready for json."""
+        return { 'stages': self.stages, 'calls': self.calls, 'counters': self.counters }
+
+def activeTrace():
+    """The trace being recorded, or None."""
+    return _trace
+
+@contextmanager
+def stage(name):
+    """Time the body of a with block as stage name of the active trace."""
+    trace = _trace
+    if trace is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, perf_counter() - start)
+
+def count(name, n=1):
+    """Add n to counter name of the active trace."""
+    if _trace is not None:
+        _trace.count(name, int(n))
+
+@contextmanager
+def tracing(trace=None):
+    """Record stages into trace (default: a new Trace) for the duration of
+    a with block, which is given the trace."""
+    global _trace
+    previous = _trace
+    _trace = Trace() if trace is None else trace
+    try:
+        yield _trace
+    finally:
+        _trace = previous
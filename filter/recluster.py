@@ -3,17 +3,20 @@
 A program to cluster colors and
 replace them with a different kind of cluster.
 """
-from PIL import Image, ImageDraw  # From the 'pillow' extension
-from filter.cluster import *
+from PIL import Image  # From the 'pillow' extension
+from filter.colorspace import findColorClustering, labelClustering, lightness
+from filter.glyphs import atlas, glyphs
+from filter.profile import count, stage
+from filter.stream import ROWS, rowChunks, streamRows
+from filter.tiles import tiled
 from random import randint, randrange
 
 from collections import OrderedDict
 import itertools as it
+import numpy as np
 
-import sys
-sys.setrecursionlimit(5000)
 
-__all__ = ( 'colorDist', 'colorMean', 'Recolor')
+__all__ = ( 'colorDist', 'colorMean', 'colorHistogram', 'paletteImage', 'Recolor')
 
 def colorMean(colors):
     """Compute the mean of a sequence of colors."""
@@ -35,6 +38,147 @@ def colorDist(c0, c1):
     db = c0[2] - c1[2]
     return (dr*dr + dg*dg + db*db)**0.5
 
+def colorHistogram(img, bits=8):
+    """Count the r-g-b colors of an image.
+    Returns an (N,3) array of distinct colors and an array of pixel counts.
+    If bits is less than 8, each channel is first quantized to that many
+    bits, and colors are reported at the center of their bin.
+    The image (or (h x w x 3) array of pixels) is read a band of rows at
+    a time, and only the distinct colors found so far are kept."""
+    shift = 8 - bits
+    keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    bands = []
+    for _, px in rowChunks(img):
+        px = px.reshape(-1, 3) >> shift
+        packed = (px[:,0].astype(np.int64) << 2*bits) | (px[:,1].astype(np.int64) << bits) | px[:,2]
+        bands.append(np.unique(packed, return_counts=True))
+        # merge once the bands hold as many colors as the merged counts,
+        # so every color is merged a few times at most
+        if sum(len(bandKeys) for bandKeys, _ in bands) >= len(keys):
+            keys, counts = mergeCounts([ (keys, counts) ] + bands)
+            bands = []
+    keys, counts = mergeCounts([ (keys, counts) ] + bands)
+    mask = (1 << bits) - 1
+    colors = np.stack([ keys >> 2*bits, (keys >> bits) & mask, keys & mask ], axis=1)
+    colors = colors.astype(np.uint8) << shift
+    if shift > 0:
+        colors |= 1 << (shift - 1)
+    return colors, counts
+
+def mergeCounts(parts):
+    """Helper method for colorHistogram.
+    Merge a list of (keys, counts) pairs into one, with sorted keys."""
+    keys = np.concatenate([ partKeys for partKeys, _ in parts ])
+    counts = np.concatenate([ partCounts for _, partCounts in parts ])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=counts, minlength=len(keys)).astype(np.int64)
+
+def countIteration(iteration, variance, seconds):
+    """Helper method for Recolor and Smooth.
+    The callback of findClustering: counts every clustering iteration."""
+    count('clusterIterations')
+
+def paletteImage(img, clustering, palette, jobs=1):
+    """Generate an r-g-b image replacing each pixel of img with palette[i],
+    where i is the index of the cluster its color is classified into.
+    With jobs other than 1, stripes of the image are mapped in parallel."""
+    px = np.asarray(img.convert("RGB"))
+    return Image.fromarray(tiled(paletteArray, px, 3, (clustering, palette), jobs=jobs), "RGB")
+
+def paletteArray(px, clustering, palette):
+    """Helper method for paletteImage.
+    Map an (h x w x 3) array of pixels to their palette colors.
+    Each distinct color is classified once; the result is applied to all
+    pixels as a single array lookup."""
+    # pack r-g-b into one integer per pixel and find the distinct colors
+    keys = (px[...,0].astype(np.int32) << 16) | (px[...,1].astype(np.int32) << 8) | px[...,2]
+    keys, inverse = np.unique(keys.ravel(), return_inverse=True)
+    colors = np.stack([ keys >> 16, (keys >> 8) & 255, keys & 255 ], axis=1).astype(np.uint8)
+    # map every distinct color to its output color, then every pixel
+    lut = np.asarray(palette, dtype=np.uint8)[ clustering.classifyAll(colors) ]
+    return lut[inverse.ravel()].reshape(px.shape)
+
+def regionValues(keys, regions, n):
+    """Helper method for squareValues and Rehatch.
+    Returns array of the value of each of n regions, from 0 (black) to
+    10 (white), given the packed r-g-b color and the region of every
+    pixel.  A region's value comes from the mean of its distinct colors.
+    This stands in for the original region search, and is timed as its
+    'dfs' stage."""
+    with stage('dfs'):
+        # every distinct (region, color) pair once
+        pairs = np.unique((regions.astype(np.int64) << 24) | keys)
+        regions, keys = pairs >> 24, pairs & 0xFFFFFF
+        colors = np.bincount(regions, minlength=n)
+        # mean of the distinct colors of every region
+        mean = [ np.bincount(regions, weights=(keys >> shift) & 255, minlength=n) // colors
+                 for shift in (16, 8, 0) ]
+    # get brightness by averaging r, g, b values
+    brightness = mean[0]/3 + mean[1]/3 + mean[2]/3
+    # convert brightness from 0 (black) - 255 (white)
+    # to 0 (black) - 10 (white) brighness
+    return ((brightness / 255) * 10).astype(np.intp)
+
+def packColors(px):
+    """Helper method for squareValues and Rehatch.
+    Pack every r-g-b pixel of an array into one integer."""
+    return (px[...,0].astype(np.int64) << 16) | (px[...,1].astype(np.int64) << 8) | px[...,2]
+
+def squareValues(px, square, bottom=True, lut=None):
+    """Returns (rows x cols) array of the value of every square x square
+    block of an (h x w x 3) array of pixels, from 0 (black) to 10 (white).
+    Height and width must be multiples of square.
+    If lut is given, every channel of every pixel is first looked up in it.
+    As in the original region search, the last column of pixels is left
+    out of the squares, and so is the last row if bottom is True (px ends
+    at the bottom of the image): they are regions of their own, drawn by
+    Rehatch.drawEdges.
+    Pixels are read a band of rows of squares at a time, so px may be
+    mapped from a file (see filter.source.mapPixels)."""
+    height, width = px.shape[:2]
+    step = max(1, ROWS // square) * square
+    values = [ bandValues(px[top:top+step], square, bottom and top + step >= height, lut)
+               for top in range(0, height, step) ]
+    if not values:
+        return np.zeros((0, width//square), dtype=np.intp)
+    return np.concatenate(values)
+
+def bandValues(px, square, bottom, lut):
+    """Helper method for squareValues.
+    The values of the squares of one band of rows of pixels."""
+    height, width = px.shape[:2]
+    rows, cols = height//square, width//square
+    if lut is not None:
+        px = lut[px]
+    # square of every pixel
+    ys, xs = np.arange(height) // square, np.arange(width) // square
+    regions = ys[:, None] * cols + xs[None, :]
+    keys = packColors(px)
+    if square > 1:
+        inside = np.ones((height, width), dtype=bool)
+        inside[:, -1:] = False
+        if bottom:
+            inside[-1:, :] = False
+        regions, keys = regions[inside], keys[inside]
+    return regionValues(keys.ravel(), regions.ravel(), rows*cols).reshape(rows, cols)
+
+def hatchArray(px, square, tiles, lut=None):
+    """Helper method for Rehatch.
+    Replace every square of an (h x w x 3) array of pixels with the tile
+    of its value; returns an (h x w x 4) array.  The array is taken not to
+    end at the bottom of the image (see squareValues)."""
+    return stampArray(squareValues(px, square, False, lut), tiles)
+
+def stampArray(values, tiles):
+    """Helper method for Rehatch.
+    Lay out the tile of every value in a (rows x cols) array of values;
+    returns a (rows*square x cols*square x 4) array."""
+    rows, cols = values.shape
+    square = tiles.shape[1]
+    # look up the tile of every square, then lay the squares out in rows
+    i = tiles[ values ]
+    return i.swapaxes(1, 2).reshape(rows*square, cols*square, 4)
+
 # Classic colors:
 WHITE = (255,255,255)
 BLACK = (0,0,0)
@@ -42,12 +186,14 @@ BLACK = (0,0,0)
 class Recluster(object):
     """Recolor an image replacing k-clustered colors with input colors.
     Makes use of a clustering of 'k' values."""
-    __slots__ = ['_width', '_height', '_image', '_px']
+    __slots__ = ['_width', '_height', '_image']
 
     def __init__(self, img):
         self._image = img
-        self._width,self._height = img.size
-        self._px = img.load()
+        if isinstance(img, np.ndarray):
+            self._height, self._width = img.shape[:2]
+        else:
+            self._width,self._height = img.size
 
     @property
     def width(self):
@@ -59,17 +205,15 @@ class Recluster(object):
         """The height of the image produced by this filter."""
         return self._height
 
-    def brightnessRGBDict(self, RGBList):
+    def brightnessRGBDict(self, RGBList, space='rgb'):
         """From a list of rgb tuples,
-        generate an ordered dictionary between brightness and rgb."""
+        generate an ordered dictionary between brightness and rgb.
+        Brightness is the average of r, g and b, or the lightness the
+        color has in space ('lab' or 'oklab')."""
         # temporary dictonary to hold rgb values
         d = {}
         # get every rgb tuple in list
-        for rgb in RGBList:
-            # get brightness by averaging r, g, b values
-            brightness = 0
-            for color in rgb:
-                brightness += (color / 3)
+        for rgb, brightness in zip(RGBList, lightness(np.asarray(RGBList), space).tolist()):
             # key is brightness, value is rgb tuple
             d[brightness] = rgb
         # convert ordered dict to keep values sorted by brightness
@@ -79,26 +223,50 @@ class Recluster(object):
 class Recolor(Recluster):
     """Takes list of rgb tuples as input.
     Replaces clusters colors with input colors."""
-    __slots__ = ['_clust', '_input']
+    __slots__ = ['_clust', '_input', '_space']
 
-    def __init__(self, img, k, input):
+    def __init__(self, img, k, input, bits=8, labels=None, seed=None, batchSize=None,
+                 space='rgb', initial=None):
         # create cluster
         super().__init__(img)
-        # here, we cluster based on unique r-g-b tuples that represent the colors
-        pixelSet = { self._px[x,y][:3] for y in range(self.height) for x in range(self.width)}
-        self._clust = findClustering(pixelSet, k, colorMean, colorDist)
+        # colors are clustered, matched and ordered by lightness in space
+        self._space = space
+        # centers from an earlier clustering of this image skip clustering;
+        # initial centers (e.g. of the previous frame) are refined instead
+        if labels is not None:
+            self._clust = labelClustering(labels, space)
+        else:
+            # here, we cluster the r-g-b colors weighted by how many pixels use them
+            with stage('cluster'):
+                colors, counts = colorHistogram(img, bits)
+                self._clust = findColorClustering(colors, k, space, weights=counts,
+                                                  seed=seed, batchSize=batchSize,
+                                                  seeding=initial, callback=countIteration)
         # get input
         self._input = input
 
+    @property
+    def clustering(self):
+        """The clustering of the image's colors."""
+        return self._clust
+
+    @property
+    def centers(self):
+        """The centers of the clusters in the color space, which can be
+        given as labels to skip clustering this image again."""
+        if self._space == 'rgb':
+            return self._clust.label
+        return self._clust.clustering.label
+
     def clusterInputDict(self):
         """Generate a dictonary between cluster colors and input colors in
         order of light to dark."""
         # make dict from light to dark rgb tuples from clusters
         clusters = self._clust.label
-        clustersDict = self.brightnessRGBDict(clusters)
+        clustersDict = self.brightnessRGBDict(clusters, self._space)
         input = self._input
         # make dict from light to dark rgb tuples from input
-        inputDict = self.brightnessRGBDict(input)
+        inputDict = self.brightnessRGBDict(input, self._space)
         # assocaite each cluster color with each input color,
         # both already in light to dark order
         clusterInputDict = {}
@@ -106,85 +274,49 @@ class Recolor(Recluster):
                 clusterInputDict[ cluster ] = input
         return clusterInputDict
 
-    def image(self):
-        """Generate an image replacing cluster colors with input colors."""
-        # create a new image
-        width, height = self.width, self.height
-        i = Image.new("RGB",(width,height),WHITE)
-        # generate image by classifying all the colors
+    def image(self, jobs=1):
+        """Generate an image replacing cluster colors with input colors.
+        With jobs other than 1, stripes of the image are mapped in parallel."""
         clustering = self._clust
         # get dictonary of cluster color to input color
         clusterInputDict = self.clusterInputDict()
-        for y in range(height):
-            for x in range(width):
-                # grab the original color
-                c = self._px[x,y][:3]
-                # generate clustered color
-                clusterC = clustering.label[ clustering.classify(c) ]
-                # get associated input color
-                inputC = clusterInputDict[ clusterC ]
-                # paint it into the image
-                ImageDraw.Draw(i).point((x,y), inputC)
-        return i
-
-class ReclusterDFS(Recluster):
-    """Includes Depth-First Search to find neighboring pixels with same color."""
-    __slots__ = ['_visited']
-
-    def __init__(self, map):
-        super().__init__(map)
-        # keeps track of all the pixels that have been visited by DFS
-        self._visited = []
-
-    def dfs(self, color, pixel):
-        """Depth-First Search for neighboring pixels with same color.
-        Returns list of pixel and neighbors with same color."""
-        pixelList = [ pixel ]
-        # get x, y points of pixel
-        x, y = pixel[0], pixel[1]
-        # check that x + 1 is within the bounds of image
-        # then get right neighbor
-        if (x + 1) < (self.width - 1):
-            rightNeighbor = [x+1, y]
-            pixelList = self.addNeighbor(color, pixelList, rightNeighbor)
-        # repeat for bottom neighbor
-        if (y + 1) < (self.height - 1):
-            bottomNeighbor = [x, y+1]
-            pixelList = self.addNeighbor(color, pixelList, bottomNeighbor)
-        # return list of itself and all its neigbors with same color
-        return pixelList
-
-    def addNeighbor(self, color, pixelList, neighbor):
-        """Adds neighbor to pixel list, if it has the same color and has not
-        been visited."""
-        # get x, y points of neighbor
-        nX, nY = neighbor[0], neighbor[1]
-        # get color of neighbor
-        mapColor = self._px[ nX, nY ]
-        # if this neighbor has not already been visited and
-        # is the same color as pixel
-        # then add it to visited & search its neighbors
-        if ( neighbor not in self._visited ) and ( mapColor == color ):
-            self._visited.append( neighbor )
-            pixelList.extend( self.dfs(color, neighbor) )
-        return pixelList
-
-class Remap(ReclusterDFS):
+        # get associated input color for every cluster
+        palette = [ clusterInputDict[label] for label in clustering.label ]
+        # generate image by classifying all the colors
+        count('pixelsDrawn', self.width * self.height)
+        with stage('map'):
+            return paletteImage(self._image, clustering, palette, jobs)
+
+    def stream(self, file, rows=ROWS):
+        """Write the image replacing cluster colors with input colors to
+        file (a path or binary file) as a PNG, a band of rows at a time."""
+        clusterInputDict = self.clusterInputDict()
+        palette = [ clusterInputDict[label] for label in self._clust.label ]
+        count('pixelsDrawn', self.width * self.height)
+        streamRows(self._image, paletteArray, (self._clust, palette), file, rows)
+
+class Remap(Recluster):
     """Remaps pixels depending on given map. All white pixels will be
-    back image and all other pixels will be front image."""
-    slots = ['_front', '_frontPX', '_back', '_backPx']
+    back image and all other pixels will be front image.
+    If soft is True, the map is instead read as a greyscale mask: white
+    is back image, black is front image, and greys blend the two, which
+    keeps anti-aliased map edges smooth.
+    A mask computed earlier (e.g. on a smaller copy of the map) can be
+    given instead; it is resized to the map."""
+    slots = ['_front', '_back', '_soft', '_mask']
 
-    def __init__(self, map, front, back):
+    def __init__(self, map, front, back, soft=False, mask=None):
         super().__init__(map)
-        # get front image and then resize
-        self._front = self.resizeToMap(front)
-        self._frontPx = self._front.load()
-        # get back image and then resize
-        self._back = self.resizeToMap(back)
-        self._backPx = self._back.load()
+        with stage('resize'):
+            # get front image and then resize
+            self._front = self.resizeToMap(front)
+            # get back image and then resize
+            self._back = self.resizeToMap(back)
+        self._soft = soft
+        self._mask = mask
 
     def resizeToMap(self, image):
-        """Resizes image to fit the map."""
+        """Resizes image to cover the map, then crops it to the map's size."""
         # get aspect ratio of map and image
         mapAspectRatio = self.width / self.height
         imageAspectRatio = image.width / image.height
@@ -196,7 +328,7 @@ class Remap(ReclusterDFS):
             mapHeight = self.height
             hpercent = (mapHeight/float(image.size[1]))
             wsize = int((float(image.size[0])*float(hpercent)))
-            image = image.resize((wsize,mapHeight), Image.ANTIALIAS)
+            image = image.resize((wsize,mapHeight), Image.LANCZOS)
         # otherwise the image has a greater height aspect,
         # then its width must be resized
         # ( or it has the same aspect ratio, in which case it dosen't matter )
@@ -206,113 +338,139 @@ class Remap(ReclusterDFS):
             mapWidth = self.width
             wpercent = (mapWidth/float(image.size[0]))
             hsize = int((float(image.size[1])*float(wpercent)))
-            image = image.resize((mapWidth,hsize), Image.ANTIALIAS)
-        return image
+            image = image.resize((mapWidth,hsize), Image.LANCZOS)
+        # keep the top-left part that lines up with the map
+        return image.convert("RGB").crop((0, 0, self.width, self.height))
+
+    def mask(self):
+        """Returns the greyscale mask of the map: 255 where the back image
+        shows, 0 where the front image shows."""
+        if self._mask is not None:
+            resample = Image.BILINEAR if self._soft else Image.NEAREST
+            return self._mask.resize(self._image.size, resample)
+        if self._soft:
+            return self._image.convert("L")
+        # white pixels are back image; everything else is front image
+        px = np.asarray(self._image.convert("RGB"))
+        white = (px == WHITE).all(axis=2)
+        return Image.fromarray(white.astype(np.uint8) * 255, "L")
 
     def image(self):
         """Creates an image that maps all the back pixels onto
         the white pixels of the map and all the front pixels onto
         the black pixels of the map."""
-        # create a new image
-        width, height = self.width, self.height
-        i = Image.new("RGB",(width,height),WHITE)
-
-        # for the y and x pixels
-        for y in range(height):
-            for x in range(width):
-                # define pixel
-                pixel = [x, y]
-                # if pixel has already been visited, skip it
-                if pixel in self._visited:
-                    continue
-                self._visited.append(pixel)
-                # get the color of pixel
-                color = self._px[x,y][:3]
-                # get all the neighbors with the same color
-                neighborList = self.dfs(color, pixel)
-                # if the color is white, then it's the background image
-                if color == (255, 255, 255):
-                    colorImage = self._backPx
-                # otherwise it's the front image
-                else:
-                    colorImage = self._frontPx
-                for neighbor in neighborList:
-                    nX, nY = neighbor[0], neighbor[1]
-                    newC = colorImage[nX, nY]
-                    ImageDraw.Draw(i).point((nX, nY), newC)
-        return i
-
-class Rehatch(ReclusterDFS):
-    """Overlays a chessboard to create "squares" of value on an image.
+        with stage('mask'):
+            mask = self.mask()
+        count('pixelsDrawn', self.width * self.height)
+        with stage('map'):
+            return Image.composite(self._back, self._front, mask)
+
+class Rehatch(Recluster):
+    """Cuts an image into "squares" of value.
     Then replaces every square of value with a corresponding value on
-    a value scale."""
-    slots=['_square', '_dots', '_start', '_startPx']
+    a value scale.
+    Values computed earlier (e.g. on a smaller copy of the image) can be
+    given instead; they are stretched to this image's squares.
+    The image may also be an (h x w x c) array of r-g-b(-a) pixels, such
+    as those of a file mapped by filter.source.mapPixels, and lut a table
+    every channel of every pixel is looked up in before its value is found
+    (see filter.py's contrastTable)."""
+    slots=['_square', '_style', '_start', '_values', '_lut']
 
-    def __init__(self, start, square, style):
+    def __init__(self, start, square, style, values=None, lut=None):
         self._square = square
-        self._dots = {}
-        # get the value scale, based on the style
-        for value in range(10):
-            dot = Image.open("filter/{}/{}.png".format(style, value))
-            self._dots[value] = dot.resize((self._square, self._square), Image.NEAREST)
-        self._start = self.cropToSquare(start)
-        self._startPx = self._start.load()
-        map = self.chessboard( self._start.width, self._start.height )
-        super().__init__(map)
+        # the value scale is looked up by style
+        self._style = style
+        self._values = values
+        self._lut = lut
+        with stage('crop'):
+            self._start = self.cropToSquare(start)
+        super().__init__(self._start)
 
     def cropToSquare(self, image):
         """Returns cropped image that can be cut into square pixel tiles.
         Ex.: if square is 10x10: 1813x2013 => 1810x2010."""
+        if isinstance(image, np.ndarray):
+            height, width = image.shape[:2]
+            return image[:height - height % self._square, :width - width % self._square]
         nWidth = image.width - ( image.width % self._square )
         nHeight = image.height - ( image.height % self._square )
         image = image.crop((0, 0, nWidth, nHeight))
         return image
 
-    def chessboard(self, width, height):
-        """Creates chessboard with size (width x height) of 5x5 squares"""
-        w, h = width//self._square, height//self._square
-        img = Image.new("RGB", (w,h))
-        pixels = img.load()
-        # make pixels white, where row+col is odd
-        for i in range(w):
-            for j in range(h):
-                if (i+j)%2:
-                    pixels[i,j] = (255,255,255)
-        # then resize back to square-size chess fields
-        img = img.resize((self._square*w, self._square *h), Image.NEAREST)
-        return img
+    def pixels(self):
+        """The (h x w x 3) r-g-b pixels of the cropped image, before lut."""
+        if isinstance(self._start, np.ndarray):
+            return self._start[..., :3]
+        return np.asarray(self._start.convert("RGB"))
 
-    def image(self):
-        # create a new image
-        width, height = self.width, self.height
-        i = Image.new("RGBA",(width,height),WHITE)
-
-        # for the y and x pixels
-        for y in range(height):
-            for x in range(width):
-                # define pixel
-                pixel = [x, y]
-                # if pixel has already been visited, skip it
-                if pixel in self._visited:
-                    continue
-                # get the color of pixel
-                color = self._px[x,y][:3]
-                # get all the neighbors with the same color
-                neighborList = self.dfs(color, pixel)
-                colorSet = set()
-                for neighbor in neighborList:
-                    nX, nY = neighbor[0], neighbor[1]
-                    color = self._startPx[nX, nY]
-                    colorSet.add(color)
-                # get clustering of all the images in square
-                clust = findClustering(colorSet, 1, colorMean, colorDist)
-                brightness = 0
-                for color in clust._label[0]:
-                    brightness += (color / 3)
-                # convert brightness from 0 (black) - 255 (white)
-                # to 0 (black) - 10 (white) brighness
-                brightness = int((brightness / 255) * 10)
-                if brightness != 10:
-                    hatch = self._dots[brightness]
-                    i.paste(hatch, (x, y), mask=hatch)
-        return i
+    def values(self):
+        """Returns (rows x cols) array of the value of every square,
+        from 0 (black) to 10 (white)."""
+        if self._values is not None:
+            # stretch values found on another grid to this one
+            rows, cols = self.height//self._square, self.width//self._square
+            values = Image.fromarray(self._values.astype(np.uint8))
+            return np.asarray(values.resize((cols, rows), Image.NEAREST)).astype(np.intp)
+        return squareValues(self.pixels(), self._square, lut=self._lut)
+
+    def tiles(self):
+        """Returns (11 x square x square x 4) array of what every value
+        looks like drawn on white; value 10 is left white."""
+        return atlas(self._style, self._square)
+
+    def image(self, jobs=1):
+        """Generate an image replacing every square with its value's hatch.
+        With jobs other than 1, rows of squares are drawn in parallel."""
+        with stage('tiles'):
+            tiles = self.tiles()
+        squares = (self.width // self._square) * (self.height // self._square)
+        count('squares', squares)
+        count('regions', squares)
+        count('pixelsDrawn', self.width * self.height)
+        with stage('map'):
+            if self._values is not None:
+                return Image.fromarray(stampArray(self.values(), tiles), "RGBA")
+            px = self.pixels()
+            i = tiled(hatchArray, px, 4, (self._square, tiles, self._lut),
+                      align=self._square, jobs=jobs)
+            i = np.ascontiguousarray(i)
+            self.drawEdges(i, px, tiles)
+            return Image.fromarray(i, "RGBA")
+
+    def drawEdges(self, i, px, tiles):
+        """Helper method for image.
+        Finish the (h x w x 4) array i of the squares of the (h x w x 3)
+        pixels px the way the original region search drew them: the
+        bottom row of squares leaves out the last row of pixels, and the
+        last column and last row of pixels, cut where the squares are
+        cut, are regions of their own.  Their glyphs are pasted over the
+        squares at their first pixel, clipped by the image's edge."""
+        sq = self._square
+        height, width = px.shape[:2]
+        if sq == 1 or height == 0 or width == 0:
+            return
+        # squares of the bottom row, without the last row of pixels
+        i[-sq:] = stampArray(squareValues(px[-sq:], sq, lut=self._lut), tiles)
+        # (top, left, pixels) of every edge region, in the order pasted
+        edges = [ (top, width-1, px[top:min(top+sq, height-1), width-1])
+                  for top in range(0, height, sq) ]
+        edges += [ (height-1, left, px[height-1, left:min(left+sq, width-1)])
+                   for left in range(0, width, sq) ]
+        edges.append((height-1, width-1, px[height-1:, width-1]))
+        lut = self._lut
+        keys = np.concatenate([ packColors(pixels if lut is None else lut[pixels])
+                                for _, _, pixels in edges ])
+        regions = np.repeat(np.arange(len(edges)), [ len(pixels) for _, _, pixels in edges ])
+        values = regionValues(keys, regions, len(edges))
+        count('regions', len(edges))
+        hatches = {}
+        for (top, left, _), value in zip(edges, values.tolist()):
+            if value == 10:
+                continue
+            if value not in hatches:
+                hatches[value] = glyphs(self._style)[value].resize((sq, sq), Image.NEAREST)
+            hatch = hatches[value]
+            part = Image.fromarray(np.ascontiguousarray(i[top:top+sq, left:left+sq]), "RGBA")
+            part.paste(hatch, (0, 0), mask=hatch)
+            i[top:top+sq, left:left+sq] = np.asarray(part)
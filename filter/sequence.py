@@ -0,0 +1,128 @@
+# Filtering sequences of frames.
+"""Filter a sequence of frames, such as the frames of a video.
+
+Frames are read, filtered and written by "pipelined": one thread decodes
+the next frames and another encodes the last ones while the filter works
+on the current frame, with at most "depth" frames waiting at each step.
+
+A "PaletteTracker" keeps the palette steady from frame to frame.  It
+remembers the cluster centers of the last frame that was clustered and a
+coarse color histogram of that frame.  A frame whose histogram has
+drifted less than "drift" from it reuses the centers as they are; any
+other frame is clustered starting from them, which takes few iterations
+and keeps each color in the same cluster as in the frames before.
+"""
+from queue import Queue
+from threading import Thread
+
+import numpy as np
+
+from filter.profile import count
+from filter.recluster import colorHistogram
+
+__all__ = ['PaletteTracker', 'coarseHistogram', 'histogramDrift', 'pipelined']
+
+# bits per channel of the histograms frames are compared by
+HISTOGRAM_BITS = 4
+# default share of pixels that may change color before a frame is clustered again
+DRIFT = 0.1
+# default frames waiting to be filtered, and to be written
+DEPTH = 4
+
+def coarseHistogram(img, bits=HISTOGRAM_BITS):
+    """The share of the pixels of img in every bin of a histogram with
+    bits bits per channel, as a flat array."""
+    colors, counts = colorHistogram(img, bits)
+    keys = (colors.astype(np.int32) >> (8 - bits))
+    keys = (keys[:, 0] << 2*bits) | (keys[:, 1] << bits) | keys[:, 2]
+    histogram = np.zeros(1 << 3*bits)
+    histogram[keys] = counts
+    return histogram / histogram.sum()
+
+def histogramDrift(a, b):
+    """The share of pixels that would have to change bins to turn
+    histogram a into histogram b (from 0, the same, to 1)."""
+    return 0.5 * np.abs(a - b).sum()
+
+class PaletteTracker(object):
+    """The cluster centers of the frames of a sequence so far."""
+    __slots__ = ['_drift', '_centers', '_histogram', '_pending']
+
+    def __init__(self, drift=DRIFT):
+        self._drift = drift
+        self._centers = None
+        self._histogram = None
+        self._pending = None
+
+    @property
+    def centers(self):
+        """The centers of the last frame that was clustered, or None."""
+        return self._centers
+
+    def clusters(self, img):
+        """Returns (labels, initial) for clustering frame img: labels to
+        use as they are if the frame is close enough to the last one that
+        was clustered, otherwise initial centers to start from (None for
+        the first frame).  One of the two is always None."""
+        histogram = coarseHistogram(img)
+        if self._centers is not None and \
+           histogramDrift(histogram, self._histogram) <= self._drift:
+            count('framesReused')
+            return self._centers, None
+        count('framesClustered')
+        self._pending = histogram
+        return None, self._centers
+
+    def update(self, centers):
+        """Remember the centers found for the frame last given to clusters."""
+        if self._pending is not None:
+            self._centers, self._histogram, self._pending = centers, self._pending, None
+
+def _reader(frames, read, inbox):
+    """Helper method for pipelined.
+    Decode every frame into inbox, then a None."""
+    try:
+        for frame in frames:
+            inbox.put((frame, read(frame), None))
+    except Exception as e:
+        inbox.put((None, None, e))
+    inbox.put(None)
+
+def _writer(write, outbox, errors):
+    """Helper method for pipelined.
+    Encode every result from outbox until a None."""
+    while True:
+        item = outbox.get()
+        if item is None:
+            return
+        try:
+            write(*item)
+        except Exception as e:
+            errors.append(e)
+
+def pipelined(frames, read, work, write, depth=DEPTH):
+    """For every frame in order, call write(frame, work(read(frame))).
+    Reading the next frames and writing the last ones run in threads of
+    their own, so they overlap with work.  Returns the number of frames."""
+    inbox, outbox, errors = Queue(maxsize=depth), Queue(maxsize=depth), []
+    reader = Thread(target=_reader, args=(frames, read, inbox), daemon=True)
+    writer = Thread(target=_writer, args=(write, outbox, errors))
+    reader.start()
+    writer.start()
+    done = 0
+    try:
+        while True:
+            item = inbox.get()
+            if item is None:
+                break
+            frame, image, error = item
+            if error is not None:
+                raise error
+            outbox.put((frame, work(image)))
+            done += 1
+    finally:
+        outbox.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return done
@@ -6,9 +6,15 @@ Use in the following way:
 image.png defaults to 'bedroom.png'; k defaults to 8.
 The result will appear in image-k.png.
 """
-from PIL import Image, ImageDraw  # From the 'pillow' extension
-from cluster import *
+from PIL import Image  # From the 'pillow' extension
+from filter.cluster import *
+from filter.colorspace import findColorClustering, fromSpace, toSpace
+from filter.profile import count, stage
+from filter.recluster import colorHistogram, countIteration, paletteArray, paletteImage
+from filter.stream import ROWS, streamRows
+from copy import copy
 from random import randint
+import numpy as np
 
 __all__ = ( 'colorDist', 'colorMean', 'Recolor')
 
@@ -39,17 +45,27 @@ BLACK = (0,0,0)
 class Smooth(object):
     """Recolor an image replacing k-clustered colors with input colors.
     Makes use of a clustering of 'k' values."""
-    __slots__ = ['_width', '_height', '_image', '_px', '_clust', '_k', '_smoothK']
+    __slots__ = ['_width', '_height', '_image', '_clust', '_k', '_smoothK',
+                 '_labels', '_index', '_space']
 
-    def __init__(self, img, k=40, smoothK=20):
+    def __init__(self, img, k=40, smoothK=20, bits=8, seed=None, batchSize=None,
+                 space='rgb'):
         self._image = img
         self._width,self._height = img.size
-        self._px = img.load()
-        # here, we cluster based on unique r-g-b tuples that represent the colors
-        pixelSet = { self._px[x,y][:3] for y in range(self.height) for x in range(self.width)}
-        self._clust = findClustering(pixelSet, k, colorMean, colorDist)
+        # here, we cluster the r-g-b colors weighted by how many pixels use them
+        with stage('cluster'):
+            colors, counts = colorHistogram(img, bits)
+            self._clust = findColorClustering(colors, k, space, weights=counts,
+                                              seed=seed, batchSize=batchSize,
+                                              callback=countIteration)
+        # colors are clustered and merged in space
+        self._space = space
         self._k = k
         self._smoothK = smoothK
+        # the colors drawn, and which one each cluster is drawn with;
+        # smooth() merges clusters by changing these
+        self._labels = self._clust.label
+        self._index = np.arange(self._clust.k)
 
     @property
     def width(self):
@@ -61,9 +77,10 @@ class Smooth(object):
         """The height of the image produced by this filter."""
         return self._height
 
-    def image(self, showColors = False):
+    def image(self, showColors = False, jobs=1):
         """Generate an image from this filter.
-        If showColors is True, the palette is drawn below the image."""
+        If showColors is True, the palette is drawn below the image.
+        With jobs other than 1, stripes of the image are mapped in parallel."""
 
         # create a new image.  Includes palette, if showColors is True.
         width, height = self.width, self.height
@@ -71,32 +88,50 @@ class Smooth(object):
         i = Image.new("RGB",(width,height+palatteHeight),WHITE)
 
         # generate image by classifying all the colors
-        clustering = self._clust
-        for y in range(height):
-            for x in range(width):
-                # grab the original color
-                c = self._px[x,y][:3]
-                # generate the new color
-                newC = clustering.label[ clustering.classify(c) ]
-                # paint it into the image
-                ImageDraw.Draw(i).point((x,y), newC)
+        count('pixelsDrawn', width * height)
+        with stage('map'):
+            i.paste(paletteImage(self._image, self._clust, self.palette(), jobs), (0, 0))
 
         # if showColors, at bottom, build a palette of k color swatches
-        k = clustering.k
-        # compute the width of the palette bars
-        palWid = (width+k-1)//k
-        for py in range(palatteHeight):
-            y = py + height
-            for x in range(i.width):
-                swatchIndex = x//palWid
-                swatch = clustering.label[swatchIndex]
-                ImageDraw.Draw(i).point((x,y),swatch)
+        if palatteHeight:
+            k = len(self._labels)
+            # compute the width of the palette bars
+            palWid = (width+k-1)//k
+            swatches = np.asarray(self._labels, dtype=np.uint8)[ np.arange(width)//palWid ]
+            bar = np.broadcast_to(swatches, (palatteHeight, width, 3))
+            i.paste(Image.fromarray(np.ascontiguousarray(bar), "RGB"), (0, height))
         return i
+
+    def stream(self, file, rows=ROWS):
+        """Write the image from this filter to file (a path or binary file)
+        as a PNG, a band of rows at a time."""
+        streamRows(self._image, paletteArray, (self._clust, self.palette()), file, rows)
+
+    def palette(self):
+        """The color each cluster of the image is drawn with."""
+        return np.asarray(self._labels, dtype=np.uint8)[ self._index ]
     #!
     def smooth(self):
-        """Return clusters from image in a smoothed out way."""
-        if (self._k < self._smoothK):
-            return self
-        else:
-            return Smooth(self.image(), (self._k)//2).smooth()
+        """Return clusters from image in a smoothed out way.
+        k is halved until it is less than smoothK.  Each level merges the
+        clusters of the level before, weighted by their pixels, so the
+        image is only drawn once, at the end."""
+        result = copy(self)
+        labels, index = self._labels, self._index
+        # number of pixels in every cluster of the current level
+        weights = np.bincount(index[self._clust.assignment], self._clust.weights,
+                              minlength=len(labels))
+        k = self._k
+        with stage('cluster'):
+            while k >= self._smoothK:
+                k = k//2
+                merged, mergedIndex = mergeClusters(toSpace(labels, self._space), weights, k)
+                weights = np.bincount(mergedIndex, weights, minlength=len(merged))
+                # colors are whole numbers, as in a drawn image
+                labels = tuple( tuple(c) for c in fromSpace(merged, self._space).tolist() )
+                index = mergedIndex[index]
+        result._k = k
+        result._labels = labels
+        result._index = index
+        return result
     #!
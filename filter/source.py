@@ -0,0 +1,82 @@
+# Opening input images with as little decoding as possible.
+"""Open input images, decoding no more than a filter needs.
+
+"openImage(path, fit)" opens an image for a filter that will shrink it
+to cover fit = (width, height) anyway: JPEGs are then decoded at a reduced
+scale (1/2, 1/4 or 1/8) that still covers DRAFT_MARGIN times fit, which is
+several times faster and smaller than decoding them whole.  The margin
+leaves the filter's own resize enough pixels to smooth over the cruder
+scaling of the decoder.
+
+"mapPixels(path)" memory-maps the pixels of an image stored uncompressed
+(PPM, uncompressed TIFF, 24-bit BMP) as a read-only (h x w x c) array,
+so rows are only read from disk when they are used.  "rowChunks" and
+"colorHistogram" take such arrays as well as images, so a mapped file
+can be read a band of rows at a time.
+"""
+import numpy as np
+from PIL import Image
+
+__all__ = ['openImage', 'mapPixels']
+
+# how many times larger than needed reduced JPEGs are decoded
+DRAFT_MARGIN = 2
+# channels of the raw pixel layouts that can be mapped, by PIL raw mode;
+# BGR is mapped as RGB read backwards
+RAW_CHANNELS = { 'L': 1, 'RGB': 3, 'RGBA': 4, 'BGR': 3 }
+
+def rawLayout(img):
+    """Helper method for mapPixels.
+    The (offset, stride, rawmode, bottomUp) of the pixels of an opened but
+    unloaded image, if they are one uncompressed block in the file;
+    otherwise None."""
+    tiles = img.tile
+    if not tiles or any( tile[0] != 'raw' for tile in tiles ):
+        return None
+    # every tile must be a band of whole rows, in order and back to back
+    args = tiles[0][3]
+    rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else args
+    channels = RAW_CHANNELS.get(rawmode)
+    if channels is None or img.mode != rawmode.replace('BGR', 'RGB'):
+        return None
+    stride = stride or img.width * channels
+    if len(tiles) > 1 and orientation < 0:
+        return None
+    top, offset = 0, tiles[0][2]
+    for _, extents, tileOffset, tileArgs in tiles:
+        if tileArgs != args or extents != (0, top, img.width, extents[3]) or \
+           tileOffset != offset + top * stride:
+            return None
+        top = extents[3]
+    if top != img.height:
+        return None
+    return offset, stride, rawmode, orientation < 0
+
+def mapPixels(path):
+    """A read-only (h x w x c) array of the pixels of the image at path,
+    mapped from the file, or None if they are not stored uncompressed."""
+    with Image.open(path) as img:
+        layout = rawLayout(img)
+        width, height = img.size
+    if layout is None:
+        return None
+    offset, stride, rawmode, bottomUp = layout
+    channels = RAW_CHANNELS[rawmode]
+    rows = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(height, stride))
+    px = rows[:, :width * channels].reshape(height, width, channels)
+    if bottomUp:
+        px = px[::-1]
+    if rawmode == 'BGR':
+        px = px[..., ::-1]
+    return px
+
+def openImage(path, fit=None):
+    """Open and load the image at path.
+    If fit is given, the image is going to be shrunk to cover a (width,
+    height) box, and JPEGs are decoded at the smallest scale that still
+    covers it with DRAFT_MARGIN to spare."""
+    img = Image.open(path)
+    if fit is not None and img.format == 'JPEG':
+        img.draft(img.mode, (fit[0] * DRAFT_MARGIN, fit[1] * DRAFT_MARGIN))
+    img.load()
+    return img
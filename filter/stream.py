@@ -0,0 +1,96 @@
+# Streaming row-by-row image output.
+"""Map an image to a PNG file a band of rows at a time.
+
+"rowChunks" reads an image as bands of at most "rows" rows of r-g-b pixels,
+and "PNGWriter" encodes bands of rows as they arrive, so neither the mapped
+image nor the encoded file is ever held whole in memory.  "streamRows" puts
+the two together: memory use depends on the width of the image and the
+band height, not on the height of the image.  It times the mapping of
+every band as stage 'map' and its encoding as stage 'encode'.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+from filter.profile import stage
+
+__all__ = ['rowChunks', 'PNGWriter', 'streamRows']
+
+# default number of rows mapped at a time
+ROWS = 256
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types, by number of channels
+COLOR_TYPES = { 1: 0, 3: 2, 4: 6 }
+
+def rowChunks(img, rows=ROWS):
+    """Generate (top, band) pairs covering img, where band is an
+    (h x width x 3) array of r-g-b pixels with h at most rows.
+    img may also be an (height x width x 3) array, such as the pixels of
+    a file mapped by filter.source.mapPixels; only a band of it is read
+    at a time."""
+    if isinstance(img, np.ndarray):
+        for top in range(0, img.shape[0], rows):
+            yield top, np.ascontiguousarray(img[top:top+rows, :, :3])
+        return
+    for top in range(0, img.height, rows):
+        bottom = min(img.height, top + rows)
+        band = img.crop((0, top, img.width, bottom)).convert("RGB")
+        yield top, np.asarray(band)
+
+class PNGWriter(object):
+    """Encodes an 8-bit greyscale, r-g-b or r-g-b-a PNG one band of rows at
+    a time.  Rows must be written top to bottom, then the writer closed."""
+    __slots__ = ['_file', '_width', '_height', '_channels', '_written', '_compressor']
+
+    def __init__(self, file, width, height, channels=3, level=6):
+        self._file = file
+        self._width = width
+        self._height = height
+        self._channels = channels
+        self._written = 0
+        self._compressor = zlib.compressobj(level)
+        file.write(PNG_SIGNATURE)
+        header = struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPES[channels], 0, 0, 0)
+        self._chunk(b'IHDR', header)
+
+    def _chunk(self, kind, data):
+        """Write one PNG chunk."""
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, band):
+        """Encode an (h x width x channels) uint8 array of rows."""
+        band = np.asarray(band, dtype=np.uint8).reshape(-1, self._width * self._channels)
+        # every row starts with its filter type; 0 is no filtering
+        filtered = np.zeros((len(band), band.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 1:] = band
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+        self._written += len(band)
+
+    def close(self):
+        """Finish the image; every row must have been written."""
+        if self._written != self._height:
+            raise ValueError("wrote {} of {} rows".format(self._written, self._height))
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+
+def streamRows(img, function, args, file, rows=ROWS, channels=3):
+    """Write function(band, *args) for every band of rows of img to file
+    (a path or a binary file object) as a PNG with the given channels."""
+    if isinstance(file, str):
+        with open(file, 'wb') as f:
+            return streamRows(img, function, args, f, rows, channels)
+    writer = PNGWriter(file, img.width, img.height, channels)
+    for _, band in rowChunks(img, rows):
+        with stage('map'):
+            band = function(band, *args)
+        with stage('encode'):
+            writer.write(band)
+    with stage('encode'):
+        writer.close()
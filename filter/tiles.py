@@ -0,0 +1,76 @@
+# Tile-parallel execution of per-pixel filters.
+"""Run a per-pixel filter over horizontal stripes of an image in parallel.
+
+The "tiled" function takes a function that maps an (h x w x c) array of
+source rows to an (h x w x channels) array of output rows, and applies it to
+stripes of a source array in a pool of worker processes.  Source and output
+live in shared memory, so workers only receive the stripe bounds and write
+their rows in place; the result is the stitched output array.
+
+Stripe heights are multiples of "align", so filters that work on blocks of
+rows (like the squares of Rehatch) never see a block cut in two.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+import numpy as np
+
+__all__ = ['stripes', 'tiled']
+
+# images with fewer pixels than this are not worth spreading across processes
+MIN_PIXELS = 1 << 20
+
+def stripes(height, count, align=1):
+    """Split rows 0..height into at most count (top, bottom) stripes whose
+    heights are multiples of align (except, possibly, the last)."""
+    blocks = -(-height // align)
+    count = max(1, min(count, blocks))
+    bounds = [ min(height, (blocks * n // count) * align) for n in range(count+1) ]
+    return [ (top, bottom) for top, bottom in zip(bounds, bounds[1:]) if top < bottom ]
+
+def _stripe(job):
+    """Helper method for tiled.
+    Attach to the shared source and output and fill one stripe."""
+    function, args, source, output, top, bottom = job
+    sourceMemory, outputMemory = SharedMemory(source[0]), SharedMemory(output[0])
+    try:
+        src = np.ndarray(source[1], source[2], buffer=sourceMemory.buf)
+        out = np.ndarray(output[1], output[2], buffer=outputMemory.buf)
+        out[top:bottom] = function(src[top:bottom], *args)
+        # arrays must be released before the memory can be closed
+        del src, out
+    finally:
+        sourceMemory.close()
+        outputMemory.close()
+
+def tiled(function, px, channels, args=(), align=1, jobs=None):
+    """Return the (h x w x channels) uint8 array of function(rows, *args)
+    applied to stripes of the (h x w x c) array px by jobs processes
+    (default: one per core).  Small images are done in this process."""
+    height, width = px.shape[:2]
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or height * width < MIN_PIXELS:
+        return function(px, *args)
+
+    outShape = (height, width, channels)
+    sourceMemory = SharedMemory(create=True, size=max(1, px.nbytes))
+    outputMemory = SharedMemory(create=True, size=max(1, height * width * channels))
+    try:
+        src = np.ndarray(px.shape, px.dtype, buffer=sourceMemory.buf)
+        src[...] = px
+        source = (sourceMemory.name, px.shape, px.dtype)
+        output = (outputMemory.name, outShape, np.uint8)
+        jobList = [ (function, args, source, output, top, bottom)
+                    for top, bottom in stripes(height, jobs, align) ]
+        with ProcessPoolExecutor(max_workers=len(jobList)) as pool:
+            list(pool.map(_stripe, jobList))
+        # copy out before the shared memory goes away
+        result = np.ndarray(outShape, np.uint8, buffer=outputMemory.buf).copy()
+        del src
+    finally:
+        sourceMemory.close()
+        sourceMemory.unlink()
+        outputMemory.close()
+        outputMemory.unlink()
+    return result
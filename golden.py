@@ -0,0 +1,233 @@
+# A program to check that filters still look the way they should.
+"""
+A program to check that filters still look the way they should.
+Use in the following way:
+    python3 golden.py [--golden golden] [--filters all]
+                      [--set {name=value} ...] [--save]
+Every reference image in golden/{filter}/, named "{filter}_{image}", is
+rendered again from the image of the same name in examples/original with
+a fixed seed, and compared with the reference.  A render passes when
+few enough pixels differ by more than the filter's tolerance and its PSNR
+and SSIM are high enough (see THRESHOLDS).
+The references of the square filters were drawn by the original region
+search, and remap_james is the one in examples/remap.  Recolor's original
+clustering was not seeded, so its references are renders with the
+defaults and seed 0.  The ImageMagick filters have no references yet;
+they can be added with "--save" wherever wand is installed.
+
+"--set" changes filter.py globals for the render being checked, e.g.
+"--set batchSize=1024 jobs=4" checks mini-batch clustering drawn by four
+processes.  The same case is then also rendered with the defaults, and
+the speedup is reported next to the fidelity, so a fast path can be
+turned on once it passes.  With "--save", the renders with the defaults
+replace the references instead, after an intended change of look.
+The program exits with status 1 if any render fails.
+"""
+from argparse import ArgumentParser
+import os
+import sys
+import tempfile
+
+from PIL import Image
+import numpy as np
+
+from benchmark import COMMANDS, loadFilters, runFresh
+
+# where the images references are rendered from are kept
+ORIGINALS = 'examples/original'
+# references that are not rendered from the original of the same name
+# with the usual commands: reference name => (source image, commands)
+CASES = {
+    'remap_james.png': ('examples/original/james/j1.png',
+                        ['examples/original/james/j2.jpeg', 'examples/original/james/j3.jpg']),
+    'pixelate_earring2.png': ('examples/original/earring2.jpeg', ['4']),
+}
+# per filter: (tolerance of a channel, largest fraction of pixels beyond
+# the tolerance, smallest PSNR in dB, smallest SSIM)
+THRESHOLDS = {
+    'noir': (8, 0.01, 35.0, 0.95),
+    'sepia': (8, 0.01, 35.0, 0.95),
+    'vignette': (8, 0.01, 35.0, 0.95),
+    'vintage': (16, 0.02, 30.0, 0.90),
+    'recolor': (16, 0.02, 30.0, 0.90),
+    'remap': (8, 0.01, 35.0, 0.95),
+    'pixelate': (8, 0.01, 35.0, 0.95),
+    'dots': (8, 0.01, 35.0, 0.95),
+    'pencil': (8, 0.01, 35.0, 0.95),
+}
+# side of the windows SSIM is computed over
+SSIM_WINDOW = 7
+
+def findCases(goldenDirectory, filterNames):
+    """Helper method for check.
+    A list of (filterName, referencePath, sourcePath, commands) for every
+    reference that its source image can be found for."""
+    cases = []
+    for filterName in filterNames:
+        directory = os.path.join(goldenDirectory, filterName)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if not name.startswith(filterName + '_'):
+                continue
+            referencePath = os.path.join(directory, name)
+            if name in CASES:
+                sourcePath, commands = CASES[name]
+            else:
+                sourcePath = findSource(os.path.splitext(name[len(filterName)+1:])[0])
+                commands = COMMANDS.get(filterName, [])
+            if sourcePath is None:
+                print("{:<9} {}  no source image".format(filterName, referencePath))
+                continue
+            cases.append((filterName, referencePath, sourcePath, commands))
+    return cases
+
+def findSource(stem):
+    """Helper method for findCases.
+    The image in ORIGINALS named stem (with any extension), or None."""
+    for name in sorted(os.listdir(ORIGINALS)):
+        path = os.path.join(ORIGINALS, name)
+        if os.path.isfile(path) and os.path.splitext(name)[0] == stem:
+            return path
+    return None
+
+def pixels(path):
+    """Helper method for fidelity.
+    The r-g-b pixels of the image at path, with any transparency
+    drawn over white, as a float array."""
+    with Image.open(path) as image:
+        image = image.convert("RGBA")
+        white = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        return np.asarray(Image.alpha_composite(white, image).convert("RGB"), dtype=np.float64)
+
+def boxMean(a, size=SSIM_WINDOW):
+    """Helper method for ssim.
+    The mean of every size x size window of the 2-d array a."""
+    total = np.zeros((a.shape[0]+1, a.shape[1]+1))
+    total[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+    return (total[size:, size:] - total[:-size, size:]
+            - total[size:, :-size] + total[:-size, :-size]) / (size * size)
+
+def ssim(a, b):
+    """The mean structural similarity of the greys of two r-g-b arrays."""
+    grey = np.array([0.299, 0.587, 0.114])
+    x, y = a @ grey, b @ grey
+    if min(x.shape) < SSIM_WINDOW:
+        return 1.0 if np.array_equal(x, y) else 0.0
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mx, my = boxMean(x), boxMean(y)
+    vx = boxMean(x * x) - mx * mx
+    vy = boxMean(y * y) - my * my
+    cxy = boxMean(x * y) - mx * my
+    s = ((2 * mx * my + c1) * (2 * cxy + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    return float(s.mean())
+
+def fidelity(resultPath, referencePath, tolerance):
+    """Compare the images at resultPath and referencePath.
+    Returns a dictionary of the fraction of pixels beyond tolerance,
+    the PSNR and the SSIM, or of the reason they can't be compared."""
+    a, b = pixels(resultPath), pixels(referencePath)
+    if a.shape != b.shape:
+        return { 'error': "size {}x{}, expected {}x{}".format(a.shape[1], a.shape[0],
+                                                              b.shape[1], b.shape[0]) }
+    difference = np.abs(a - b)
+    mse = (difference * difference).mean()
+    return { 'mismatch': float((difference > tolerance).any(axis=2).mean()),
+             'psnr': float('inf') if mse == 0 else float(10 * np.log10(255 * 255 / mse)),
+             'ssim': ssim(a, b) }
+
+def passes(filterName, measures):
+    """Whether measures from fidelity are within the filter's thresholds."""
+    if 'error' in measures:
+        return False
+    _, mismatch, psnr, similarity = THRESHOLDS[filterName]
+    return measures['mismatch'] <= mismatch and measures['psnr'] >= psnr and \
+           measures['ssim'] >= similarity
+
+def check(goldenDirectory, filterNames, settings=None, save=False):
+    """Render every reference in goldenDirectory for the filters in
+    filterNames, with the filter.py globals in settings, and compare.
+    Prints a line per render and returns the number that failed."""
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for filterName, referencePath, sourcePath, commands in findCases(goldenDirectory,
+                                                                         filterNames):
+            case = { 'filter': filterName, 'path': sourcePath, 'commands': commands,
+                     'directory': directory }
+            # the defaults are the engine references were made with
+            defaultPath = os.path.join(directory, 'default.png')
+            default = runFresh(dict(case, resultPath=defaultPath))
+            if save:
+                if default['error'] is None:
+                    with Image.open(defaultPath) as image:
+                        image.save(referencePath)
+                print("{:>8.2f}s  {:<9} {}  {}".format(default['seconds'], filterName,
+                                                       referencePath, default['error'] or "saved"))
+                continue
+            if settings:
+                resultPath = os.path.join(directory, 'result.png')
+                result = runFresh(dict(case, resultPath=resultPath, settings=settings))
+            else:
+                resultPath, result = defaultPath, default
+            error = result['error'] or default['error']
+            if error is None:
+                measures = fidelity(resultPath, referencePath, THRESHOLDS[filterName][0])
+                error = measures.get('error')
+            if error is not None:
+                status = "FAIL  {}".format(error)
+            else:
+                status = "{}  mismatch {:.2%}  PSNR {:.1f}dB  SSIM {:.3f}".format(
+                    "pass" if passes(filterName, measures) else "FAIL",
+                    measures['mismatch'], measures['psnr'], measures['ssim'])
+            if not status.startswith("pass"):
+                failed += 1
+            speedup = default['seconds'] / max(result['seconds'], 1e-9)
+            print("{:>8.2f}s {:>5.2f}x  {:<9} {}  {}".format(result['seconds'], speedup,
+                                                             filterName, referencePath, status))
+    return failed
+
+def parseSetting(setting):
+    """Helper method for main.
+    Split "name=value" into name and value, a number if it looks like one."""
+    name, _, value = setting.partition('=')
+    try:
+        return name, int(value)
+    except ValueError:
+        pass
+    try:
+        return name, float(value)
+    except ValueError:
+        return name, value
+
+def main(argv):
+    """Command line for golden."""
+    parser = ArgumentParser(prog='golden.py',
+                            description='Check that filters still look the way they should.')
+    parser.add_argument('--golden', default='golden',
+                        help='directory holding a directory of references per filter')
+    parser.add_argument('--filters', nargs='+', default=['all'],
+                        help="filter names, or 'all'")
+    parser.add_argument('--set', nargs='+', default=[], dest='settings',
+                        help='filter.py globals to render with, as name=value')
+    parser.add_argument('--save', action='store_true',
+                        help='replace the references with renders made with the defaults')
+    args = parser.parse_args(argv)
+    filters = loadFilters()
+    filterNames = filters.filters if args.filters == ['all'] else args.filters
+    for filterName in filterNames:
+        if filterName not in filters.filters:
+            print("The filter {} does not exsist.".format(filterName))
+            exit(2)
+    settings = dict( parseSetting(setting) for setting in args.settings )
+    for name in settings:
+        if not hasattr(filters, name):
+            print("filter.py has no setting {}.".format(name))
+            exit(2)
+
+    failed = check(args.golden, filterNames, settings, args.save)
+    if failed:
+        print("{} renders failed.".format(failed))
+        exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])